@@ -0,0 +1,381 @@
+#!/usr/bin/python
+
+"""
+Benchmarks - runs generated scenarios against the devices and records
+machine readable results
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+import getopt
+import json
+import os
+import pickle
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import cpu_count
+from threading import Timer
+
+from coroutines import RUNTIME_SHARDED, RUNTIME_THREADS
+from device import ReusableBarrierCond, ReusableBarrierSem, STORAGE_DICT
+from sharding import FORK_SUPPORTED
+from supervisor import Supervisor
+from test import TestCase, TestCaseCache, TestParams, SCRIPT_ASSIGNMENT_RANDOM
+
+# Parameters of a scenario, everything without delays so that the device
+# engine is measured, not the sleeps
+DEFAULT_SCENARIO = {
+    "name": "default",
+    "num_nodes": 10,
+    "num_locations": 10,
+    "overlap": 1,
+    "num_scripts": 10,
+    "duration": 3,
+    "extra_duration": 0,
+    "parallel_script": False,
+    "script_assignment": SCRIPT_ASSIGNMENT_RANDOM,
+    "script_sleep": 0.0,
+    "scripts_delay": 0.0,
+    "gen_seed": 0,
+    "storage": STORAGE_DICT,
+    "timeout": 300,
+    # directory where generated test cases are saved and reused from, none if empty
+    "cache_dir": "",
+    # the maximum size of the cache directory, in MB
+    "cache_size": 1024,
+    # Chrome trace JSON file for the events of the run, no tracing if empty
+    "trace_file": "",
+    # how the devices are run, see coroutines.RUNTIMES
+    "runtime": RUNTIME_THREADS,
+    # the number of processes of the sharded runtime, one for every CPU if 0
+    "shards": 0,
+}
+
+SWEEP_DEVICES = "devices"
+SWEEP_OVERLAP = "overlap"
+SWEEPS = [SWEEP_DEVICES, SWEEP_OVERLAP]
+
+# Barrier micro-benchmark: participants and the number of times they all wait
+BARRIERS = [ReusableBarrierSem, ReusableBarrierCond]
+BARRIER_PARTICIPANTS = [10, 100, 1000]
+BARRIER_ROUNDS = 100
+
+
+def create_sweep(sweep):
+    """
+    Creates the scenarios of a scaling sweep.
+    @type sweep: String
+    @param sweep: one of SWEEPS
+    @rtype: List of Dictionary
+    @return: the scenarios
+    """
+    scenarios = []
+
+    if sweep == SWEEP_DEVICES:
+        # one location per device, one script per device
+        for num_nodes in [10, 50, 100, 500, 1000, 2000]:
+            scenarios.append(dict(DEFAULT_SCENARIO,
+                                  name="devices-%d" % num_nodes,
+                                  num_nodes=num_nodes,
+                                  num_locations=num_nodes,
+                                  num_scripts=num_nodes))
+
+    if sweep == SWEEP_OVERLAP:
+        # the same devices sharing more and more of each location
+        for overlap in [1, 2, 4, 8, 16, 32, 64, 100]:
+            scenarios.append(dict(DEFAULT_SCENARIO,
+                                  name="overlap-%d" % overlap,
+                                  num_nodes=100,
+                                  num_locations=100,
+                                  num_scripts=100,
+                                  overlap=overlap))
+
+    return scenarios
+
+
+def create_test_case(scenario):
+    """
+    Generates the test case of a scenario.
+    @type scenario: Dictionary
+    @param scenario: the scenario parameters, as in DEFAULT_SCENARIO
+    @rtype: TestCase
+    @return: the test case
+    """
+    params = TestParams(name=scenario["name"],
+                        num_devices=scenario["num_nodes"],
+                        num_locations=scenario["num_locations"],
+                        num_scripts=scenario["num_scripts"],
+                        script_delay=(scenario["scripts_delay"], scenario["scripts_delay"]),
+                        script_sleep=(scenario["script_sleep"], scenario["script_sleep"]),
+                        parallel_script=scenario["parallel_script"],
+                        timeout=scenario["timeout"],
+                        duration=scenario["duration"],
+                        overlap=scenario["overlap"],
+                        extra_duration=scenario["extra_duration"],
+                        script_assignment=scenario["script_assignment"])
+
+    cache = None
+    if scenario["cache_dir"]:
+        cache = TestCaseCache(scenario["cache_dir"], scenario["cache_size"] * 1024 * 1024)
+        key = params.cache_key(scenario["gen_seed"])
+
+    test = cache.get(key) if cache is not None else None
+    if test is None:
+        test = TestCase.create_test_case(params, random.Random(scenario["gen_seed"]))
+        if cache is not None:
+            cache.put(key, test)
+
+    test.num_iterations = 1
+    test.crt_iteration = 1
+    test.trace_file = scenario["trace_file"] or None
+    test.runtime = scenario["runtime"]
+    test.shards = scenario["shards"] or None
+    test.storage = scenario["storage"]
+
+    return test
+
+
+def run_scenario(scenario):
+    """
+    Runs a scenario in the current process and measures it. Meant to be run in
+    a fresh process, so that the thread count and the peak memory belong only
+    to this scenario.
+    @type scenario: Dictionary
+    @param scenario: the scenario parameters, as in DEFAULT_SCENARIO
+    @rtype: Dictionary
+    @return: the scenario parameters and the measurements
+    """
+    start = time.time()
+    test = create_test_case(scenario)
+    generation_time = time.time() - start
+
+    watchdog = Timer(interval=test.timeout, function=os.abort)
+    watchdog.start()
+
+    # the threads of the devices are the ones alive at the timepoint starts, besides these
+    tester_threads = threading.active_count()
+
+    supervisor = Supervisor(test, die_on_error=False)
+    supervisor.register_banned_thread(watchdog)
+    supervisor.register_banned_thread()
+
+    start = time.time()
+    errors = supervisor.run_testcase()
+    end = time.time()
+
+    watchdog.cancel()
+
+    # the sharded runtime starts the timepoints in other processes, so none are seen here
+    starts = [supervisor.timepoint_starts[tpt] for tpt in sorted(supervisor.timepoint_starts)]
+    # the counters are kept only by the threaded devices
+    devices = []
+    if scenario["runtime"] == RUNTIME_THREADS:
+        devices = [dev_rd.device for dev_rd in supervisor.devices.values()]
+    lock_stats = [stats for device in devices for stats in device.locks.stats().values()]
+
+    result = dict(scenario)
+    result.update({
+        "generation_time": generation_time,
+        "wall_time": end - start,
+        "timepoint_latency": [next_start - crt_start
+                              for (crt_start, next_start) in zip(starts, starts[1:])],
+        "scripts_per_timepoint": [sum(counts) for counts in
+                                  zip(*[device.scripts.submitted_scripts for device in devices])],
+        "tasks_per_timepoint": [sum(counts) for counts in
+                                zip(*[device.scripts.submitted_tasks for device in devices])],
+        # only the threaded devices have threads
+        "threads": max(supervisor.timepoint_threads.values() or [tester_threads])
+                   - tester_threads,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "lock_acquisitions": sum(stats[0] for stats in lock_stats),
+        "lock_contended": sum(stats[1] for stats in lock_stats),
+        "lock_wait_time": sum(stats[2] for stats in lock_stats),
+        "errors": errors,
+    })
+
+    return result
+
+
+def run_barrier(barrier_class, num_threads, rounds):
+    """
+    Measures a barrier: num_threads threads wait at it rounds times in a row.
+    @type barrier_class: Class
+    @param barrier_class: the barrier, built with the number of threads
+    @type num_threads: Integer
+    @param num_threads: the number of participants
+    @type rounds: Integer
+    @param rounds: how many times each thread waits
+    @rtype: Dictionary
+    @return: the parameters and the mean time of a round
+    """
+    barrier = barrier_class(num_threads)
+    start_barrier = barrier_class(num_threads + 1)
+
+    def participant():
+        start_barrier.wait()
+        for _ in range(rounds):
+            barrier.wait()
+
+    threads = [threading.Thread(target=participant) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+
+    # the clock starts once every thread is running
+    start_barrier.wait()
+    start = time.time()
+    for thread in threads:
+        thread.join()
+    end = time.time()
+
+    return {"barrier": barrier_class.__name__,
+            "participants": num_threads,
+            "rounds": rounds,
+            "round_time": (end - start) / rounds}
+
+
+def run_scenario_in_child(scenario):
+    """
+    Starts a child process that runs the scenario.
+    @type scenario: Dictionary
+    @param scenario: the scenario parameters, as in DEFAULT_SCENARIO
+    @rtype: Dictionary
+    @return: the scenario parameters and the measurements, or the return code
+        of the child if it failed
+    """
+    path = os.path.dirname(sys.argv[0])
+    path = "." if path == "" else path
+    command = "python %s/bench.py --run" % path
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               shell=True)
+    output, _ = process.communicate(pickle.dumps(scenario))
+
+    if process.returncode != 0:
+        return dict(scenario, return_code=process.returncode)
+
+    return json.loads(output)
+
+
+def usage(argv):
+    print "Usage: python %s [OPTIONS]"%argv[0]
+    print "options:"
+    print "\t-s,   --sweep\t\tscaling sweep to run (%s), can be given several times," % ", ".join(SWEEPS)
+    print "\t\t\t\tdefaults to all of them when no scenario is given with -p"
+    print "\t-p,   --param\t\tparameter of a single scenario, as name=value (the names of"
+    print "\t\t\t\tthe test files, plus script_sleep and scripts_delay in seconds)"
+    print "\t-b,   --barrier\t\trun the barrier micro-benchmark (%s participants)" % \
+        ", ".join(str(num) for num in BARRIER_PARTICIPANTS)
+    print "\t-c,   --cache-dir\tdirectory where the generated test cases are saved, and"
+    print "\t\t\t\tloaded from by the next runs of the same scenarios"
+    print "\t-o,   --out\t\tJSON output file, defaults to bench.json"
+    print "\t-h,   --help\t\tprint this help screen"
+
+
+def main():
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hs:p:bc:o:",
+                                ["help", "sweep=", "param=", "barrier", "cache-dir=", "out=",
+                                 "run"])
+
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(sys.argv)
+        sys.exit(2)
+
+    sweeps = []
+    scenario = None
+    barrier = False
+    output_file = "bench.json"
+    cache_dir = ""
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage(sys.argv)
+            sys.exit(0)
+        elif opt in ("-s", "--sweep"):
+            if arg not in SWEEPS:
+                print "Unknown sweep %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            sweeps.append(arg)
+        elif opt in ("-p", "--param"):
+            if scenario is None:
+                scenario = dict(DEFAULT_SCENARIO, name="custom")
+            name, _, value = arg.partition("=")
+            if name not in scenario:
+                print "Unknown parameter %s" % name
+                usage(sys.argv)
+                sys.exit(2)
+            try:
+                if isinstance(DEFAULT_SCENARIO[name], bool):
+                    scenario[name] = value in ("True", "true", "1")
+                else:
+                    scenario[name] = type(DEFAULT_SCENARIO[name])(value)
+            except ValueError, err:
+                print str(err)
+                sys.exit(2)
+        elif opt in ("-b", "--barrier"):
+            barrier = True
+        elif opt in ("-c", "--cache-dir"):
+            cache_dir = arg
+        elif opt in ("-o", "--out"):
+            output_file = arg
+        elif opt == "--run":  # I'm the child process
+            result = run_scenario(pickle.loads(sys.stdin.read()))
+            sys.stdout.write(json.dumps(result))
+            sys.stdout.flush()
+            sys.exit(0)
+        else:
+            assert False, "unhandled option"
+
+    if scenario is not None and scenario["runtime"] == RUNTIME_SHARDED and not FORK_SUPPORTED:
+        print "The %s runtime needs fork, which this platform does not have" % RUNTIME_SHARDED
+        sys.exit(2)
+
+    if scenario is not None and scenario["trace_file"] and scenario["runtime"] != RUNTIME_THREADS:
+        print "Tracing is supported only by the %s runtime" % RUNTIME_THREADS
+        sys.exit(2)
+
+    scenarios = [scenario] if scenario is not None else []
+    if not sweeps and not scenarios and not barrier:
+        sweeps = SWEEPS
+    for sweep in sweeps:
+        scenarios.extend(create_sweep(sweep))
+
+    results = []
+    for scenario in scenarios:
+        if cache_dir:
+            scenario["cache_dir"] = cache_dir
+        result = run_scenario_in_child(scenario)
+        results.append(result)
+
+        if "return_code" in result:
+            print "%-15s failed with return code %d" % (result["name"], result["return_code"])
+        else:
+            print "%-15s %8.3fs %6d threads %8d KB %8.3fs lock wait %d errors" % \
+                (result["name"], result["wall_time"], result["threads"],
+                 result["peak_rss_kb"], result["lock_wait_time"], result["errors"])
+
+    barriers = []
+    if barrier:
+        for num_threads in BARRIER_PARTICIPANTS:
+            for barrier_class in BARRIERS:
+                result = run_barrier(barrier_class, num_threads, BARRIER_ROUNDS)
+                barriers.append(result)
+                print "%-20s %5d threads %10.6fs per round" % \
+                    (result["barrier"], num_threads, result["round_time"])
+
+    with open(output_file, "w") as out_file:
+        json.dump({"python": platform.python_version(),
+                   "cpu_count": cpu_count(),
+                   "scenarios": results,
+                   "barriers": barriers}, out_file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Testing infrastructure - an alternative runtime, running the devices as coroutines on a single
+event loop instead of threads
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+
+from device import STORAGE_SHARED
+from shared_data import SharedSensorTable
+
+# How the devices of a test case are run
+RUNTIME_THREADS = "threads"         # device.Device, with its threads
+RUNTIME_COROUTINES = "coroutines"   # CoroutineDevice, on an EventLoop
+RUNTIME_SHARDED = "sharded"         # coroutines in several processes, see sharding.py
+RUNTIMES = [RUNTIME_THREADS, RUNTIME_COROUTINES, RUNTIME_SHARDED]
+
+
+class Future(object):
+    """
+    The result of something a coroutine waits for. The coroutines are generators which yield
+    the futures they wait for and are resumed with their results.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.done = False
+        self.result = None
+        self.callbacks = []
+
+    def set_result(self, result):
+        """
+        Marks the future as done, scheduling its callbacks.
+        """
+        self.done = True
+        self.result = result
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, result)
+        self.callbacks = None
+
+    def add_done_callback(self, callback):
+        """
+        Schedules a callback, called with the result once the future is done.
+        """
+        if self.done:
+            self.loop.call_soon(callback, self.result)
+        else:
+            self.callbacks.append(callback)
+
+
+class Task(object):
+    """
+    Runs a coroutine on the loop; finished is a future done when the coroutine returns.
+    """
+
+    def __init__(self, loop, coroutine):
+        self.coroutine = coroutine
+        self.finished = Future(loop)
+        loop.call_soon(self.step, None)
+
+    def step(self, value):
+        """
+        Resumes the coroutine until it waits for another future.
+        """
+        try:
+            future = self.coroutine.send(value)
+        except StopIteration:
+            self.finished.set_result(None)
+            return
+
+        future.add_done_callback(self.step)
+
+
+class EventLoop(object):
+    """
+    Runs callbacks one at a time, in the order they were scheduled, and sleeps when the only
+    thing left is to wait for timers.
+    """
+
+    def __init__(self):
+        self.ready = deque()
+        self.timers = []
+        self.order = itertools.count()
+
+    def call_soon(self, callback, arg):
+        """
+        Schedules callback(arg).
+        """
+        self.ready.append((callback, arg))
+
+    def spawn(self, coroutine):
+        """
+        @rtype: Task
+        @return: the task running the coroutine
+        """
+        return Task(self, coroutine)
+
+    def sleep(self, delay):
+        """
+        @rtype: Future
+        @return: a future done after the delay, in seconds
+        """
+        future = Future(self)
+        heapq.heappush(self.timers, (time.time() + delay, next(self.order), future))
+        return future
+
+    def run(self):
+        """
+        Runs until there is nothing left to do.
+        """
+        while self.ready or self.timers:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2].set_result(None)
+
+            if not self.ready:
+                time.sleep(self.timers[0][0] - now)
+                continue
+
+            # the callbacks scheduled meanwhile wait for the next round
+            for _ in range(len(self.ready)):
+                callback, arg = self.ready.popleft()
+                callback(arg)
+
+
+class AsyncLock(object):
+    """
+    Lock for coroutines, handed to the waiters in the order they asked for it.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.locked = False
+        self.waiters = deque()
+
+    def acquire(self):
+        """
+        @rtype: Future
+        @return: a future done once the lock is held
+        """
+        future = Future(self.loop)
+        if self.locked:
+            self.waiters.append(future)
+        else:
+            self.locked = True
+            future.set_result(None)
+        return future
+
+    def release(self):
+        """
+        Unlocks, or passes the lock to the first waiter.
+        """
+        if self.waiters:
+            self.waiters.popleft().set_result(None)
+        else:
+            self.locked = False
+
+
+class AsyncQueue(object):
+    """
+    Unbounded queue for coroutines.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.items = deque()
+        self.getters = deque()
+
+    def put(self, item):
+        """
+        Adds an item, handing it to the first waiting getter if there is one.
+        """
+        if self.getters:
+            self.getters.popleft().set_result(item)
+        else:
+            self.items.append(item)
+
+    def get(self):
+        """
+        @rtype: Future
+        @return: a future whose result is the next item
+        """
+        future = Future(self.loop)
+        if self.items:
+            future.set_result(self.items.popleft())
+        else:
+            self.getters.append(future)
+        return future
+
+
+class AsyncBarrier(object):
+    """
+    Reusable barrier for coroutines. The last one to arrive runs an optional action before the
+    others are released.
+    """
+
+    def __init__(self, loop, num_coroutines, action=None):
+        self.loop = loop
+        self.num_coroutines = num_coroutines
+        self.action = action
+        self.waiters = []
+
+    def wait(self):
+        """
+        @rtype: Future
+        @return: a future done once all the coroutines arrived
+        """
+        future = Future(self.loop)
+        self.waiters.append(future)
+        if len(self.waiters) == self.num_coroutines:
+            waiters, self.waiters = self.waiters, []
+            if self.action is not None:
+                self.action()
+            for waiter in waiters:
+                waiter.set_result(None)
+        return future
+
+
+class CoroutineDevice(object):
+    """
+    A device of the coroutine runtime: its data, a lock for every location and the queue in
+    which its scripts are delivered.
+    """
+
+    def __init__(self, loop, device_id, sensor_data):
+        """
+        Constructor.
+        @type loop: EventLoop
+        @param loop: the loop running the device
+        @type device_id: Integer
+        @param device_id: the unique id of this node; between 0 and N-1
+        @type sensor_data: Dictionary of Integer to Float
+        @param sensor_data: the data of every location of the device, a dictionary or a
+            shared_data.SharedSensorData
+        """
+        self.device_id = device_id
+        self.sensor_data = sensor_data
+        self.locks = {loc : AsyncLock(loop) for loc in sensor_data}
+        self.script_queue = AsyncQueue(loop)
+        self.scripts = []
+
+    def __str__(self):
+        return "Device %d" % self.device_id
+
+    def get_data(self, location):
+        """
+        @rtype: Float
+        @return: the pollution value for the given location, None if there is none
+        """
+        if location in self.sensor_data:
+            return self.sensor_data[location]
+        return None
+
+    def set_data(self, location, data):
+        """
+        Sets the pollution value for the given location, if the device has one.
+        """
+        if location in self.sensor_data:
+            self.sensor_data[location] = data
+
+
+def run_script(loop, device, neighbours, script_rd):
+    """
+    Coroutine running a script: the location is locked on every device involved, in the order
+    of their ids, like the device threads do, the script sleeps with the loop and the result is
+    sent to everyone.
+
+    @type script_rd: supervisor.ScriptRunData
+    @param script_rd: the script and its location
+    """
+    # pylint: disable=protected-access
+    location = script_rd.location
+    devices = {dev.device_id : dev for dev in neighbours}
+    devices[device.device_id] = device
+    holders = [devices[dev_id] for dev_id in sorted(devices)
+               if location in devices[dev_id].sensor_data]
+
+    for dev in holders:
+        yield dev.locks[location].acquire()
+
+    if holders:
+        delay = script_rd.script._Script__delay
+        if delay is not None:
+            yield loop.sleep(random.uniform(delay[0], delay[1]))
+
+        result = script_rd.script._Script__update([dev.sensor_data[location] for dev in holders])
+        for dev in holders:
+            dev.sensor_data[location] = result
+
+    for dev in holders:
+        dev.locks[location].release()
+
+
+def deliver_batch(loop, device, delay, scripts):
+    """
+    Coroutine delivering a batch of scripts: all but the last one after the delay, the last one
+    after twice the delay, like supervisor.ScriptDispatcher.
+    """
+    yield loop.sleep(delay)
+    for script_rd in scripts[:-1]:
+        device.script_queue.put(script_rd)
+
+    if scripts:
+        yield loop.sleep(delay)
+        device.script_queue.put(scripts[-1])
+
+
+def deliver(loop, device, batches):
+    """
+    Coroutine delivering the scripts of a device for a timepoint, then the end of the timepoint.
+    """
+    tasks = [loop.spawn(deliver_batch(loop, device, delay, scripts))
+             for (delay, scripts) in batches]
+    for task in tasks:
+        yield task.finished
+
+    device.script_queue.put(None)
+
+
+def run_device(loop, supervisor, device, devices, barrier, runner=run_script):
+    """
+    Coroutine doing what device.DeviceThread does: at every timepoint, run the scripts received
+    until now and the ones delivered during the timepoint, then wait for the other devices.
+    The scripts are run by runner coroutines, which have the parameters of run_script.
+    """
+    testcase = supervisor.testcase
+
+    for crt_timepoint in range(testcase.duration + testcase.extra_duration):
+        supervisor.timepoint_starts.setdefault(crt_timepoint, time.time())
+
+        neighbours = [devices[neigh_id] for neigh_id in
+                      supervisor.neighbour_ids.get((device.device_id, crt_timepoint), ())]
+        loop.spawn(deliver(loop, device, supervisor.script_batches(device.device_id,
+                                                                   crt_timepoint)))
+
+        tasks = [loop.spawn(runner(loop, device, neighbours, script_rd))
+                 for script_rd in device.scripts]
+        new_scripts = []
+        while True:
+            script_rd = yield device.script_queue.get()
+            if script_rd is None:
+                break
+            new_scripts.append(script_rd)
+            tasks.append(loop.spawn(runner(loop, device, neighbours, script_rd)))
+
+        for task in tasks:
+            yield task.finished
+        device.scripts.extend(new_scripts)
+
+        yield barrier.wait()
+
+
+class CoroutineRuntime(object):
+    """
+    Runs the test case of a supervisor with coroutines: a CoroutineDevice and a run_device
+    coroutine for every device, all on one EventLoop.
+    """
+
+    def __init__(self, supervisor):
+        """
+        Creates the devices, which the supervisor validates like the threaded devices.
+        @type supervisor: supervisor.Supervisor
+        @param supervisor: the supervisor of the test case
+        """
+        self.supervisor = supervisor
+        self.loop = EventLoop()
+
+        testcase = supervisor.testcase
+        table = None
+        if testcase.storage == STORAGE_SHARED:
+            table = SharedSensorTable.create(testcase.devices,
+                                             supervisor.iteration_filename(testcase.data_file))
+
+        self.devices = {}
+        for device_testdata in testcase.devices:
+            if table is not None:
+                sensor_data = table.device_data(device_testdata.id)
+            else:
+                sensor_data = {loc : data for (loc, data) in device_testdata.locations}
+            self.devices[device_testdata.id] = CoroutineDevice(self.loop, device_testdata.id,
+                                                               sensor_data)
+
+    def run(self):
+        """
+        Runs the simulation until every device ends its last timepoint.
+        """
+        action = None
+        if self.supervisor.testcase.check_timepoints:
+            # the last device to end a timepoint validates it, before anyone starts the next one
+            timepoints = itertools.count()
+            action = lambda: self.supervisor.validate_bounds(next(timepoints))
+        barrier = AsyncBarrier(self.loop, len(self.devices), action)
+
+        for device in self.devices.values():
+            self.loop.spawn(run_device(self.loop, self.supervisor, device, self.devices, barrier))
+
+        self.loop.run()
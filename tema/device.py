@@ -6,19 +6,36 @@ Assignment 1
 March 2019
 """
 
-from threading import Event, Thread, Lock, Semaphore
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from threading import Condition, Thread, Lock, Semaphore
+from time import time
 from Queue import Queue
 
+# Sensor data storage, see Device.storage
+STORAGE_DICT = "dict"
+STORAGE_ARRAY = "array"
+STORAGE_SHARED = "shared"
+STORAGES = [STORAGE_DICT, STORAGE_ARRAY, STORAGE_SHARED]
+
+# Upper bounds, in seconds, of the buckets of the lock wait and hold time
+# histograms: 1us, 2us, 4us, ... ~0.5s, the last bucket having no bound
+HISTOGRAM_BOUNDS = [1e-6 * 2 ** i for i in range(20)]
+
 
 class ThreadPool(object):
     """
         Class that implements a thread pool (a queue of tasks from
-        which every thread being in idle state, will take one)
+        which every thread being in idle state, will take one). A single
+        pool is shared by all the devices, every task carrying the device
+        that submitted it.
     """
-    def __init__(self, num_threads, device):
-        self.__device = device
+    def __init__(self, num_threads):
         self.__queue = Queue(num_threads)
-        self.__threads = [Thread(target=self.work) for _ in range(num_threads)]
+        self.__threads = [Thread(target=self.work, name="Pool Thread %d" % i)
+                          for i in range(num_threads)]
 
         for thread in self.__threads:
             thread.start()
@@ -28,74 +45,456 @@ class ThreadPool(object):
             While a finish command is not received, after the current thread
             finishes a job, it will get another one from the queue. Then it will
             get information about the current location, from every neighbour and
-            add it to a list, alongside its device information and run the script
-            (using the run method from Script class). The last step is to inform
-            all the neighbours with the current value and mark the current task
-            "as done"
+            add it to a list, alongside the owner device information and run the
+            scripts of the task (using the run method from Script class). The
+            last step is to inform all the neighbours with the current value and
+            mark the task "as done" for the device that submitted it
         """
         while True:
-            script, location, neighbours = self.__queue.get()
-
-            if not script and not neighbours:
-                self.__queue.task_done()
+            tracer = Device.tracer
+            replay = Device.replay
+            replaying = replay is not None and replay.replaying
+            if tracer is not None:
+                start = time()
+
+            # when replaying, the tasks are taken in the recorded order
+            if replaying:
+                task = replay.next_task()
+            else:
+                task = self.__queue.get()
+
+            if task is None:
+                if not replaying:
+                    self.__queue.task_done()
                 break
 
+            owner, scripts, location, neighbours, index = task
+
+            if tracer is not None:
+                timepoint = owner.scripts.timepoint()
+                tracer.record("queue wait", start, owner.device_id, timepoint)
+                start = time()
+
+            # the locations of all the devices involved are locked in the
+            # same order by every script, so overlapping neighbourhoods
+            # cannot deadlock
+            devices = ThreadPool.lock_order(owner, neighbours)
             script_data = []
 
-            # collect data from current neighbours
-            for device in neighbours:
-                if self.__device.device_id != device.device_id:
-                    data = device.get_data(location)
-                    if data is not None:
-                        script_data.append(data)
+            # collect data from current neighbours and from us
+            for device in devices:
+                data = device.acquire_data(location)
+                if data is not None:
+                    script_data.append(data)
 
-            # add our data, if any
-            data = self.__device.get_data(location)
-            if data is not None:
-                script_data.append(data)
+            if replay is not None:
+                replay.task_acquired(owner.device_id, owner.scripts.timepoint(), index)
 
-            if script_data != []:
-                # run script on data
-                result = script.run(script_data)
+            if tracer is not None:
+                tracer.record("gather", start, owner.device_id, timepoint,
+                              location=location, devices=len(devices))
+                start = time()
 
-                # update data of neighbours
-                for device in neighbours:
-                    if self.__device.device_id != device.device_id:
-                        device.set_data(location, result)
+            if script_data != []:
+                # run the scripts on data; after a script, every device
+                # involved holds its result, which is what the next script
+                # would gather if it ran on its own
+                result = scripts[0].run(script_data)
+                for script in scripts[1:]:
+                    result = script.run([result] * len(script_data))
+
+                if tracer is not None:
+                    tracer.record("scripts", start, owner.device_id, timepoint,
+                                  location=location, scripts=len(scripts))
+                    start = time()
+
+                # update data of neighbours and our data
+                for device in devices:
+                    device.release_data(location, result)
+
+                if tracer is not None:
+                    tracer.record("update", start, owner.device_id, timepoint,
+                                  location=location)
+
+            owner.pending_tasks.decrement()
+            if not replaying:
+                self.__queue.task_done()
 
-                # update our data
-                self.__device.set_data(location, result)
-            self.__queue.task_done()
+    @staticmethod
+    def lock_order(owner, neighbours):
+        """
+            Returns the devices a script works with, each one once, sorted by
+            id. This is the order in which their location locks are taken.
+        :param owner: the device which runs the script
+        :param neighbours: device's neighbours
+        """
+        devices = {device.device_id: device for device in neighbours}
+        devices[owner.device_id] = owner
+        return [devices[dev_id] for dev_id in sorted(devices)]
 
-    def add_tasks(self, scripts, neighbours):
+    def add_tasks(self, device, scripts, neighbours):
         """
-            Add task to be done.
-        :param script: the script to be executed
-        :param location: current device's location
+            Add tasks to be done on behalf of a device. The scripts for the same
+            location become a single task, as they work on the same devices.
+        :param device: the device which submits the scripts
+        :param scripts: list of (script, location) pairs to be executed
         :param neighbours: device's neighbours
+        :return: the number of tasks
         """
+        batches = OrderedDict()
         for script, location in scripts:
-            self.__queue.put((script, location, neighbours))
-
-    def wait_threads(self):
+            batches.setdefault(location, []).append(script)
+
+        # the tasks are numbered in the order the device submits them in the
+        # timepoint, for Device.replay
+        replay = Device.replay
+        timepoint = device.scripts.timepoint()
+        first = device.scripts.submitted_tasks[-1]
+
+        device.pending_tasks.increment(len(batches))
+        for index, (location, batch) in enumerate(batches.items(), first):
+            task = (device, batch, location, neighbours, index)
+            if replay is not None and replay.replaying:
+                replay.submit(device.device_id, timepoint, index, task)
+            else:
+                self.__queue.put(task)
+
+        return len(batches)
+
+    @staticmethod
+    def wait_tasks(device):
         """
-            Wait for all threads to finish their job.
+            Wait for all the tasks submitted by a device to finish.
+        :param device: the device whose tasks are waited
         """
-        self.__queue.join()
+        device.pending_tasks.wait()
 
     def stop_threads(self):
         """
             Send end command to every thread and wait them to finish.
         """
-        self.__queue.join()
+        if Device.replay is not None and Device.replay.replaying:
+            Device.replay.stop()
+        else:
+            self.__queue.join()
 
-        for thread in self.__threads:
-            self.__queue.put((None, None, None))
+            for _ in self.__threads:
+                self.__queue.put(None)
 
         for thread in self.__threads:
             thread.join()
 
 
+class TaskCounter(object):
+    """
+        Counts the tasks a device has in the shared thread pool, so that the
+        device can wait only for its own tasks
+    """
+    def __init__(self):
+        self.__count = 0
+        self.__cond = Condition()
+
+    def increment(self, count=1):
+        """
+            Mark new tasks as pending
+        """
+        with self.__cond:
+            self.__count += count
+
+    def decrement(self):
+        """
+            Mark a task as done and wake up the waiter if it was the last one
+        """
+        with self.__cond:
+            self.__count -= 1
+            if self.__count == 0:
+                self.__cond.notify_all()
+
+    def wait(self):
+        """
+            Block until there are no pending tasks
+        """
+        with self.__cond:
+            while self.__count > 0:
+                self.__cond.wait()
+
+
+class LocationLocks(object):
+    """
+        One lock for every location of a device. Counts, for every lock, the
+        acquisitions, the ones which had to wait and the time spent waiting.
+    """
+    def __init__(self, locations):
+        self.__locks = dict()
+        self.__stats = dict()
+        for loc in locations:
+            self.__locks[loc] = Lock()
+            self.__stats[loc] = [0, 0, 0.0]
+
+    def key(self, location):
+        """
+            Returns the key of the lock used for a location
+        """
+        return location
+
+    def acquire(self, location):
+        """
+            Lock a location
+        :return: true if the lock was held by another thread, so this one
+            had to wait
+        """
+        key = self.key(location)
+        lock = self.__locks[key]
+        wait = None
+        if not lock.acquire(False):
+            start = time()
+            lock.acquire()
+            wait = time() - start
+
+        # the counters are protected by the lock itself
+        stats = self.__stats[key]
+        stats[0] += 1
+        if wait is not None:
+            stats[1] += 1
+            stats[2] += wait
+
+        return wait is not None
+
+    def release(self, location):
+        """
+            Unlock a location
+        """
+        self.__locks[self.key(location)].release()
+
+    def stats(self):
+        """
+            Returns a dictionary from lock key to [acquisitions, acquisitions
+            which had to wait, seconds spent waiting]
+        """
+        return self.__stats
+
+
+class StripedLocks(LocationLocks):
+    """
+        A fixed number of locks shared by all the locations of a device, the
+        lock of a location being chosen by its id. A script locks a single
+        location on every device it works with, so sharing a lock between
+        locations may delay a script, but can not deadlock.
+    """
+    def __init__(self, num_stripes):
+        LocationLocks.__init__(self, range(num_stripes))
+        self.__num_stripes = num_stripes
+
+    def key(self, location):
+        """
+            Returns the key of the lock used for a location
+        """
+        return location % self.__num_stripes
+
+
+class LockMetrics(object):
+    """
+        Contention metrics of the lock of a location: the acquisitions, the
+        ones which had to wait and histograms of the wait and hold times. Only
+        the thread holding the lock updates them.
+    """
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.hold_time = 0.0
+        self.wait_histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.hold_histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.acquired = None
+
+    def add(self, other):
+        """
+            Add the metrics of another lock to these ones
+        """
+        self.acquisitions += other.acquisitions
+        self.contended += other.contended
+        self.wait_time += other.wait_time
+        self.hold_time += other.hold_time
+        for i in range(len(self.wait_histogram)):
+            self.wait_histogram[i] += other.wait_histogram[i]
+            self.hold_histogram[i] += other.hold_histogram[i]
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        """
+            Returns the upper bound of the bucket holding the given fraction of
+            a histogram's values, None for the last bucket (unbounded)
+        """
+        rank = fraction * sum(histogram)
+        count = 0
+        for i, bucket in enumerate(histogram):
+            count += bucket
+            if count >= rank and count > 0:
+                return HISTOGRAM_BOUNDS[i] if i < len(HISTOGRAM_BOUNDS) else None
+        return 0.0
+
+
+class ContentionLocks(object):
+    """
+        Wraps the locks of a device (LocationLocks or StripedLocks), keeping
+        LockMetrics for every location, whichever lock it uses. The metrics of
+        a location are only touched while its lock is held.
+    """
+    def __init__(self, locks, locations):
+        self.__locks = locks
+        self.__metrics = {loc: LockMetrics() for loc in locations}
+
+    def acquire(self, location):
+        """
+            Lock a location, measuring how long it took
+        """
+        start = time()
+        contended = self.__locks.acquire(location)
+        acquired = time()
+
+        wait = acquired - start
+        metrics = self.__metrics[location]
+        metrics.acquisitions += 1
+        if contended:
+            metrics.contended += 1
+        metrics.wait_time += wait
+        metrics.wait_histogram[bisect_left(HISTOGRAM_BOUNDS, wait)] += 1
+        metrics.acquired = acquired
+
+    def release(self, location):
+        """
+            Unlock a location, measuring how long it was held
+        """
+        metrics = self.__metrics[location]
+        hold = time() - metrics.acquired
+        metrics.hold_time += hold
+        metrics.hold_histogram[bisect_left(HISTOGRAM_BOUNDS, hold)] += 1
+
+        self.__locks.release(location)
+
+    def stats(self):
+        """
+            Returns the statistics of the wrapped locks, see LocationLocks.stats
+        """
+        return self.__locks.stats()
+
+    def metrics(self):
+        """
+            Returns a dictionary from location to its LockMetrics
+        """
+        return self.__metrics
+
+
+class ArraySensorData(object):
+    """
+        Compact storage for the sensor data of a device, with the same
+        dictionary operations used by Device: the location ids are kept sorted
+        in an array, the values in an array of doubles at the same positions
+        (slots) and a bitmap tells which location ids are present.
+    """
+    def __init__(self, sensor_data):
+        self.__ids = array('l', sorted(sensor_data))
+        self.__values = array('d', [sensor_data[loc] for loc in self.__ids])
+        self.__present = bytearray((self.__ids[-1] >> 3) + 1 if self.__ids else 0)
+        for loc in self.__ids:
+            self.__present[loc >> 3] |= 1 << (loc & 7)
+
+    def __contains__(self, location):
+        return 0 <= location < len(self.__present) << 3 and \
+            self.__present[location >> 3] & (1 << (location & 7)) != 0
+
+    def __slot(self, location):
+        if location not in self:
+            raise KeyError(location)
+        return bisect_left(self.__ids, location)
+
+    def __getitem__(self, location):
+        return self.__values[self.__slot(location)]
+
+    def __setitem__(self, location, data):
+        self.__values[self.__slot(location)] = data
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def __iter__(self):
+        return iter(self.__ids)
+
+
+class ScriptRegistry(object):
+    """
+        The scripts of a device: the ones received in previous timepoints,
+        which are run at every timepoint, and the ones received in the current
+        one. Counts the scripts and the tasks submitted in every timepoint.
+        Used only by the device thread.
+    """
+    def __init__(self):
+        self.persistent = []
+        self.pending = []
+        self.submitted_scripts = []
+        self.submitted_tasks = []
+
+    def start_timepoint(self):
+        """
+            Start a new timepoint, the scripts of the previous one become
+            persistent
+        :return: the scripts to run at the start of the timepoint
+        """
+        self.persistent.extend(self.pending)
+        self.pending = []
+        self.submitted_scripts.append(0)
+        self.submitted_tasks.append(0)
+        return self.persistent
+
+    def timepoint(self):
+        """
+            Returns the number of the current timepoint, counted from 0
+        """
+        return len(self.submitted_scripts) - 1
+
+    def add(self, scripts):
+        """
+            Add the scripts received in the current timepoint
+        """
+        self.pending.extend(scripts)
+
+    def count_submitted(self, num_scripts, num_tasks):
+        """
+            Count scripts submitted in the current timepoint
+        """
+        self.submitted_scripts[-1] += num_scripts
+        self.submitted_tasks[-1] += num_tasks
+
+
+class ReusableBarrierCond(object):
+    """
+        Reusable barrier built on a single Condition. A generation counter
+        tells the waiting threads that the barrier they wait for has opened,
+        so there is a single phase and no per-thread release loop.
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.count_threads = self.num_threads
+        self.generation = 0
+        self.cond = Condition()
+
+    def wait(self):
+        """
+            Wait for threads
+        """
+        with self.cond:
+            generation = self.generation
+            self.count_threads -= 1
+            if self.count_threads == 0:
+                self.generation += 1
+                self.count_threads = self.num_threads
+                self.cond.notify_all()
+                return
+
+            while generation == self.generation:
+                self.cond.wait()
+
+
 class ReusableBarrierSem(object):
     """
         Bariera reentranta, implementata folosind semafoare
@@ -147,6 +546,27 @@ class Device(object):
     Class that represents a device.
     """
     num_threads = 8
+    # how the sensor data is stored: a dictionary (STORAGE_DICT), arrays
+    # (STORAGE_ARRAY), which take much less memory for many locations, or
+    # shared_table (STORAGE_SHARED), which other processes can read
+    storage = STORAGE_DICT
+    # the shared_data.SharedSensorTable holding the data of all the devices,
+    # with STORAGE_SHARED
+    shared_table = None
+    # number of locks shared by the locations of a device; None means a lock
+    # for each location
+    lock_stripes = 64
+    # size of the thread pool shared by all the devices; None means
+    # num_threads for every device, but at most num_threads per CPU core * 4
+    pool_threads = None
+    # a tracing.Tracer recording where the time goes, None when not tracing
+    tracer = None
+    # wrap the locks in ContentionLocks, measuring the wait and hold times
+    lock_metrics = False
+    # a replay.Recorder logging the order of the scripts, tasks and barrier
+    # waits, or a replay.Replayer running them in a recorded order; None for
+    # neither
+    replay = None
 
     def __init__(self, device_id, sensor_data, supervisor):
         """
@@ -159,18 +579,26 @@ class Device(object):
         @param supervisor: the testing infrastructure's control and validation component
         """
         self.device_id = device_id
-        self.sensor_data = sensor_data
+        if Device.storage == STORAGE_ARRAY:
+            self.sensor_data = ArraySensorData(sensor_data)
+        elif Device.storage == STORAGE_SHARED:
+            self.sensor_data = Device.shared_table.device_data(device_id)
+        else:
+            self.sensor_data = sensor_data
+        if Device.lock_stripes is not None:
+            self.locks = StripedLocks(Device.lock_stripes)
+        else:
+            self.locks = LocationLocks(sensor_data)
+        if Device.lock_metrics:
+            self.locks = ContentionLocks(self.locks, sensor_data)
         self.supervisor = supervisor
-        self.script_received = Event()
-        self.script_received.clear()
-        self.scripts = []
-        self.timepoint_done = Event()
+        self.scripts = ScriptRegistry()
+        self.script_queue = Queue()
+        self.pending_tasks = TaskCounter()
+        self.pool = None
         self.thread = DeviceThread(self)
         self.thread.start()
         self.barrier = None
-        self.locks = dict()
-        for loc in sensor_data:
-            self.locks[loc] = Lock()
 
     def __str__(self):
         """
@@ -188,10 +616,27 @@ class Device(object):
         """
         # we don't need no stinkin' setup
         if self.device_id == 0:
-            self.barrier = ReusableBarrierSem(len(devices))
+            self.barrier = ReusableBarrierCond(len(devices))
+            self.pool = ThreadPool(Device.get_pool_size(len(devices)))
             for device in devices:
                 if device.device_id != 0:
                     device.barrier = self.barrier
+                    device.pool = self.pool
+
+    @staticmethod
+    def get_pool_size(num_devices):
+        """
+        Computes the number of threads of the shared thread pool.
+        @type num_devices: Integer
+        @param num_devices: the number of devices in the simulation
+        @rtype: Integer
+        @return: the number of threads
+        """
+        if Device.pool_threads is not None:
+            return Device.pool_threads
+
+        return min(num_devices * Device.num_threads,
+                   Device.num_threads * cpu_count() * 4)
 
     def assign_script(self, script, location):
         """
@@ -202,22 +647,21 @@ class Device(object):
         @type location: Integer
         @param location: the location for which the script is interested in
         """
-        if script is not None:
-            self.scripts.append((script, location))
-            self.script_received.set()
-        else:
-            self.timepoint_done.set()
+        # the device thread blocks on this queue, a (None, None) pair marks
+        # the end of the current timepoint
+        self.script_queue.put((script, location))
 
     def get_data(self, location):
         """
         Returns the pollution value this device has for the given location.
+        The value is read without locking, so observers never wait for (or
+        hold) the locks of the scripts; use acquire_data to update it.
         @type location: Integer
         @param location: a location for which obtain the data
         @rtype: Float
         @return: the pollution value
         """
         if location in self.sensor_data:
-            self.locks[location].acquire()
             return self.sensor_data[location]
 
         return None
@@ -232,7 +676,35 @@ class Device(object):
         """
         if location in self.sensor_data:
             self.sensor_data[location] = data
-            self.locks[location].release()
+
+    def acquire_data(self, location):
+        """
+        Locks the given location for an update and returns its pollution
+        value. The lock is held until release_data is called.
+        @type location: Integer
+        @param location: a location for which obtain the data
+        @rtype: Float
+        @return: the pollution value, None (and no lock taken) if this device
+            has no data for the location
+        """
+        if location in self.sensor_data:
+            self.locks.acquire(location)
+            return self.sensor_data[location]
+
+        return None
+
+    def release_data(self, location, data):
+        """
+        Sets the pollution value of a location locked by acquire_data and
+        unlocks it.
+        @type location: Integer
+        @param location: a location for which to set the data
+        @type data: Float
+        @param data: the pollution value
+        """
+        if location in self.sensor_data:
+            self.sensor_data[location] = data
+            self.locks.release(location)
 
     def shutdown(self):
         """
@@ -242,6 +714,10 @@ class Device(object):
         """
         self.thread.join()
 
+        # the pool is shared, so only the device which created it stops it
+        if self.device_id == 0:
+            self.pool.stop_threads()
+
 
 class DeviceThread(Thread):
     """
@@ -256,27 +732,84 @@ class DeviceThread(Thread):
         """
         Thread.__init__(self, name="Device Thread %d" % device.device_id)
         self.device = device
-        self.pool = ThreadPool(Device.num_threads, device)
 
     def run(self):
-        # hope there is only one timepoint, as multiple iterations of the loop are not supported
+        tracer = Device.tracer
+        replay = Device.replay
+        replaying = replay is not None and replay.replaying
+        device_id = self.device.device_id
+
+        # every iteration of the loop corresponds to a timepoint
         while True:
+            if tracer is not None:
+                start = time()
+
             # get the current neighbourhood
             neighbours = self.device.supervisor.get_neighbours()
+
+            if tracer is not None:
+                timepoint = self.device.scripts.timepoint() + 1
+                tracer.record("get_neighbours", start, device_id, timepoint)
+
             if neighbours is None:
                 break
 
-            while True:
-                if self.device.script_received.is_set():
-                    self.pool.add_tasks(self.device.scripts, neighbours)
-                    self.device.script_received.clear()
+            pool = self.device.pool
+            registry = self.device.scripts
+
+            # scripts received in previous timepoints are run again
+            scripts = registry.start_timepoint()
+            registry.count_submitted(len(scripts),
+                                     pool.add_tasks(self.device, scripts, neighbours))
+
+            # block until new scripts or the end of the timepoint arrive
+            timepoint_done = False
+            while not timepoint_done:
+                if tracer is not None:
+                    start = time()
+
+                if replaying:
+                    # take as many as in the recorded run
+                    scripts = [self.device.script_queue.get()
+                               for _ in range(replay.batch_size(device_id))]
+                else:
+                    scripts = [self.device.script_queue.get()]
+
+                if tracer is not None:
+                    tracer.record("script_queue wait", start, device_id, timepoint)
+
+                if not replaying:
+                    # take everything already received, to submit it together
+                    while scripts[-1][0] is not None and \
+                            not self.device.script_queue.empty():
+                        scripts.append(self.device.script_queue.get())
+
+                    if replay is not None:
+                        replay.batch_taken(device_id, len(scripts))
+
+                if scripts[-1][0] is None:
+                    scripts.pop()
+                    timepoint_done = True
+
+                registry.add(scripts)
+                registry.count_submitted(len(scripts),
+                                         pool.add_tasks(self.device, scripts, neighbours))
+
+            if tracer is not None:
+                start = time()
+
+            pool.wait_tasks(self.device)
+
+            if tracer is not None:
+                tracer.record("wait_tasks", start, device_id, timepoint)
+
+            if replay is not None:
+                replay.barrier_reached(device_id)
 
-                if self.device.timepoint_done.is_set():
-                    self.device.timepoint_done.clear()
-                    self.device.script_received.set()
-                    break
+            if tracer is not None:
+                start = time()
 
-            self.pool.wait_threads()
             self.device.barrier.wait()
 
-        self.pool.stop_threads()
+            if tracer is not None:
+                tracer.record("barrier", start, device_id, timepoint)
@@ -0,0 +1,277 @@
+"""
+Testing infrastructure - reference models used to validate the device data
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Reference model kinds
+REFERENCE_DICT = "dict"
+REFERENCE_ARRAY = "array"
+REFERENCES = [REFERENCE_DICT, REFERENCE_ARRAY]
+
+
+def create_reference(kind, testcase, scripts, neighbour_ids):
+    """
+    !!! This is not part of the assignment API, do not call it !!!
+
+    Creates a reference model.
+
+    @type kind: String
+    @param kind: one of REFERENCES
+    @type testcase: test.TestCase
+    @param testcase: the test which is validated
+    @type scripts: Dictionary of Integer to Dictionary of Integer to List of ScriptRunData
+    @param scripts: the scripts of each device, for each timepoint
+    @type neighbour_ids: Dictionary of (Integer, Integer) to Tuple of Integer
+    @param neighbour_ids: the ids of the neighbours for each (device id, timepoint)
+    @rtype: DictReference or ArrayReference
+    @return: the reference model
+    """
+    if kind == REFERENCE_ARRAY:
+        if numpy is None:
+            raise ImportError("the %s reference model needs numpy" % REFERENCE_ARRAY)
+        return ArrayReference(testcase, scripts, neighbour_ids)
+
+    return DictReference(testcase, scripts, neighbour_ids)
+
+
+class DictReference(object):
+    """
+    Reference model keeping the data of each device in a dictionary, advanced one timepoint at a
+    time.
+
+    Besides the exact data (scripts run in order of timepoint and device id), bounds valid for
+    any order of the scripts inside a timepoint are kept: scripts only raise values, so each value
+    is at least the one produced by a single run of its scripts on the previous lower bounds and
+    at most the one obtained by running the scripts until nothing changes.
+    """
+
+    # pylint: disable=protected-access
+
+    def __init__(self, testcase, scripts, neighbour_ids):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Creates the model, in the state before the first timepoint. The parameters are the ones
+        of create_reference.
+        """
+        self.scripts = scripts
+        self.neighbour_ids = neighbour_ids
+        self.data = {}
+        for device_testdata in testcase.devices:
+            self.data[device_testdata.id] = {loc : data for (loc, data) in device_testdata.locations}
+        self.low = {dev : dict(sens_data) for (dev, sens_data) in self.data.items()}
+        self.high = {dev : dict(sens_data) for (dev, sens_data) in self.data.items()}
+        self.active_scripts = []
+        self.timepoint = -1
+
+    @staticmethod
+    def __run_script(data, dev, neighbour_ids, script_rd):
+        """
+        Runs a script on the reference data, the same way a device does.
+
+        @rtype: Boolean
+        @return: true if any value was changed
+        """
+        scrpt = script_rd.script
+        location = script_rd.location
+
+        script_data = []
+        # collect data from current neighbours
+        for neigh in neighbour_ids:
+            if location in data[neigh]:
+                script_data.append(data[neigh][location])
+        # add our data, if any
+        if location in data[dev]:
+            script_data.append(data[dev][location])
+
+        # run script on data
+        if script_data == []:
+            return False
+
+        result = scrpt._Script__update(script_data)
+        changed = False
+
+        # update data of neighbours and our data
+        for neigh in neighbour_ids + (dev,):
+            if location in data[neigh] and data[neigh][location] != result:
+                data[neigh][location] = result
+                changed = True
+
+        return changed
+
+    def advance(self, time_point):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Runs the model up to (and including) the given timepoint. Every timepoint is run only
+        once, the scripts assigned so far being kept in a list.
+        """
+        while self.timepoint < time_point:
+            self.timepoint += 1
+            tpt = self.timepoint
+
+            for (dev, scripts) in sorted(self.scripts[tpt].items()):
+                self.active_scripts.extend((dev, script_rd) for script_rd in scripts)
+
+            neighbours = {dev : self.neighbour_ids.get((dev, tpt), ()) for (dev, _) in self.active_scripts}
+
+            for (dev, script_rd) in self.active_scripts:
+                DictReference.__run_script(self.data, dev, neighbours[dev], script_rd)
+
+            low = {dev : dict(sens_data) for (dev, sens_data) in self.low.items()}
+            for (dev, script_rd) in self.active_scripts:
+                group = {dev : dict(self.low[dev])}
+                for neigh in neighbours[dev]:
+                    group[neigh] = dict(self.low[neigh])
+                DictReference.__run_script(group, dev, neighbours[dev], script_rd)
+                for (neigh, sens_data) in group.items():
+                    for (loc, value) in sens_data.items():
+                        low[neigh][loc] = max(low[neigh][loc], value)
+            self.low = low
+
+            changed = True
+            while changed:
+                changed = False
+                for (dev, script_rd) in self.active_scripts:
+                    if DictReference.__run_script(self.high, dev, neighbours[dev], script_rd):
+                        changed = True
+
+    def values(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        @rtype: List of (Integer, Integer, Float, Float, Float)
+        @return: (device id, location, exact value, lower bound, upper bound) for every location
+            of every device
+        """
+        return sorted((dev, loc, value, self.low[dev][loc], self.high[dev][loc])
+                      for (dev, sens_data) in self.data.items()
+                      for (loc, value) in sens_data.items())
+
+
+class ArrayReference(object):
+    """
+    Reference model keeping the data as a devices x locations array, with a mask of the
+    locations each device has data for. Every script is a masked max over the rows of its
+    neighbourhood followed by a scatter of the result, giving the same values as DictReference.
+    """
+
+    # pylint: disable=protected-access
+
+    def __init__(self, testcase, scripts, neighbour_ids):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Creates the model, in the state before the first timepoint. The parameters are the ones
+        of create_reference.
+        """
+        self.scripts = scripts
+        self.neighbour_ids = neighbour_ids
+
+        locations = sorted(set(loc for device_testdata in testcase.devices
+                               for (loc, _) in device_testdata.locations))
+        self.columns = {loc : col for (col, loc) in enumerate(locations)}
+
+        self.data = numpy.zeros((len(testcase.devices), len(locations)))
+        self.present = numpy.zeros((len(testcase.devices), len(locations)), dtype=bool)
+        for device_testdata in testcase.devices:
+            for (loc, data) in device_testdata.locations:
+                self.data[device_testdata.id, self.columns[loc]] = data
+                self.present[device_testdata.id, self.columns[loc]] = True
+        self.low = self.data.copy()
+        self.high = self.data.copy()
+
+        self.active_scripts = []
+        self.timepoint = -1
+
+    def __compute_result(self, data, rows, col, script_rd):
+        """
+        Computes the result of a script on the rows of its neighbourhood.
+
+        @rtype: (Array of Integer, Float)
+        @return: the rows which have data for the location and the result, None if there is no
+            data
+        """
+        rows = rows[self.present[rows, col]]
+        if len(rows) == 0:
+            return rows, None
+
+        # the script's algorithm applied to the maximum of the data
+        return rows, script_rd.script._Script__update((data[rows, col].max(),))
+
+    def __run_script(self, data, rows, col, script_rd):
+        """
+        Runs a script on the rows of its neighbourhood.
+
+        @rtype: Boolean
+        @return: true if any value was changed
+        """
+        rows, result = self.__compute_result(data, rows, col, script_rd)
+        if result is None:
+            return False
+
+        changed = bool((data[rows, col] != result).any())
+        data[rows, col] = result
+
+        return changed
+
+    def advance(self, time_point):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Runs the model up to (and including) the given timepoint, like DictReference.advance.
+        """
+        while self.timepoint < time_point:
+            self.timepoint += 1
+            tpt = self.timepoint
+
+            for (dev, scripts) in sorted(self.scripts[tpt].items()):
+                # scripts for locations no device has data for never change anything
+                self.active_scripts.extend((dev, self.columns[script_rd.location], script_rd)
+                                           for script_rd in scripts
+                                           if script_rd.location in self.columns)
+
+            rows = {}
+            for (dev, _, _) in self.active_scripts:
+                if dev not in rows:
+                    rows[dev] = numpy.array(self.neighbour_ids.get((dev, tpt), ()) + (dev,), dtype=int)
+
+            for (dev, col, script_rd) in self.active_scripts:
+                self.__run_script(self.data, rows[dev], col, script_rd)
+
+            low = self.low.copy()
+            for (dev, col, script_rd) in self.active_scripts:
+                group, result = self.__compute_result(self.low, rows[dev], col, script_rd)
+                if result is not None:
+                    low[group, col] = numpy.maximum(low[group, col], result)
+            self.low = low
+
+            changed = True
+            while changed:
+                changed = False
+                for (dev, col, script_rd) in self.active_scripts:
+                    if self.__run_script(self.high, rows[dev], col, script_rd):
+                        changed = True
+
+    def values(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        @rtype: List of (Integer, Integer, Float, Float, Float)
+        @return: (device id, location, exact value, lower bound, upper bound) for every location
+            of every device
+        """
+        result = []
+        for (loc, col) in self.columns.items():
+            for dev in numpy.nonzero(self.present[:, col])[0]:
+                result.append((int(dev), loc, float(self.data[dev, col]),
+                               float(self.low[dev, col]), float(self.high[dev, col])))
+        return sorted(result)
@@ -0,0 +1,399 @@
+"""
+Testing infrastructure - records the interleaving of a run of the device threads and replays it
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+import hashlib
+import json
+import struct
+import sys
+from array import array
+from threading import Condition, Lock
+
+# Replay log files: the magic string, followed by the length of a JSON header (the test case it
+# belongs to, the digest of the final data and the length of every column) and by the columns,
+# every one a packed array of integers
+LOG_MAGIC = "REPLAYLG"
+LOG_VERSION = 2
+HEADER_LENGTH = struct.Struct("<Q")
+# a value of the data digest: device id, location id and the data as a double, which is the same
+# for every storage of the devices (the dictionaries keep the values of the tests as ints, the
+# arrays as doubles)
+DIGEST_ENTRY = struct.Struct("<qqd")
+# in this order in the file
+COLUMNS = [
+    # for every device, deliveries[delivery_offsets[i]:delivery_offsets[i + 1]] are the scripts
+    # in the order they were assigned: their index in the scripts of the device for the
+    # timepoint, END_OF_TIMEPOINT for the end of the timepoint
+    "delivery_offsets", "deliveries",
+    # for every device, the number of assignments the device thread took at once
+    "batch_offsets", "batches",
+    # the tasks of the pool, in the order in which they held all their locations
+    "task_timepoints", "task_devices", "task_indexes",
+    # the devices, in the order in which they reached the barrier
+    "barrier_devices",
+]
+END_OF_TIMEPOINT = -1
+
+
+def data_digest(devices):
+    """
+    @type devices: Dictionary of Integer to supervisor.DeviceRunData
+    @param devices: the devices of a run
+    @rtype: String
+    @return: a digest of the sensor data of all the devices
+    """
+    digest = hashlib.sha1()
+    for dev_id in sorted(devices):
+        device = devices[dev_id].device
+        for loc in sorted(device.sensor_data):
+            digest.update(DIGEST_ENTRY.pack(dev_id, loc, float(device.get_data(loc))))
+    return digest.hexdigest()
+
+
+class ReplayLog(object):
+    """
+    What a Recorder saw during a run: the header and the columns of a replay log file.
+    """
+
+    def __init__(self, header, columns):
+        """
+        Constructor.
+        @type header: Dictionary
+        @param header: the test case the log belongs to and the digest of its final data
+        @type columns: Dictionary of String to array
+        @param columns: the columns of the log, see COLUMNS
+        """
+        self.header = header
+        self.columns = columns
+
+    def save(self, filename):
+        """
+        Writes the log in a file.
+        @type filename: String
+        @param filename: the log file
+        """
+        header = dict(self.header, byteorder=sys.byteorder, version=LOG_VERSION,
+                      columns=[len(self.columns[name]) for name in COLUMNS])
+
+        with open(filename, "wb") as out_file:
+            out_file.write(LOG_MAGIC)
+            out_file.write(HEADER_LENGTH.pack(len(json.dumps(header))))
+            out_file.write(json.dumps(header))
+            for name in COLUMNS:
+                self.columns[name].tofile(out_file)
+
+    @staticmethod
+    def load(filename):
+        """
+        Reads a log written by save.
+        @type filename: String
+        @param filename: the log file
+        @rtype: ReplayLog
+        @return: the log
+        """
+        with open(filename, "rb") as in_file:
+            if in_file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise StandardError("%s is not a replay log" % filename)
+            (length,) = HEADER_LENGTH.unpack(in_file.read(HEADER_LENGTH.size))
+            header = json.loads(in_file.read(length))
+            if header["version"] != LOG_VERSION:
+                raise StandardError("Unsupported replay log version %d" % header["version"])
+
+            columns = {}
+            for (name, length) in zip(COLUMNS, header["columns"]):
+                columns[name] = array("i")
+                columns[name].fromfile(in_file, length)
+                if header["byteorder"] != sys.byteorder:
+                    columns[name].byteswap()
+
+        return ReplayLog(header, columns)
+
+    @staticmethod
+    def test_header(testcase):
+        """
+        @rtype: Dictionary
+        @return: what the log of a test case keeps about it, to check that it replays the same
+        """
+        return {"name": testcase.name,
+                "num_devices": len(testcase.devices),
+                "num_scripts": len(testcase.scripts),
+                "num_timepoints": testcase.duration + testcase.extra_duration}
+
+    def split(self, offsets_name, values_name):
+        """
+        @rtype: List of List of Integer
+        @return: the elements of every device, for a column and its offsets
+        """
+        offsets = self.columns[offsets_name]
+        values = self.columns[values_name]
+        return [values[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
+
+class Recorder(object):
+    """
+    Records the order of everything that decides the data of a run: the assignment of the
+    scripts, how the device threads take them, the order in which the tasks of the pool lock
+    their locations and the order in which the devices reach the barrier.
+
+    Every list of a device is changed only by one thread (the dispatcher or the device
+    thread), the orders of the pool and of the barrier under a lock.
+    """
+
+    replaying = False
+
+    def __init__(self, supervisor):
+        """
+        Constructor.
+        @type supervisor: supervisor.Supervisor
+        @param supervisor: the supervisor of the recorded run
+        """
+        self.supervisor = supervisor
+        num_devices = len(supervisor.testcase.devices)
+        # the index of every script in the scripts of its device for its timepoint
+        self.script_indexes = {}
+        for scripts in supervisor.scripts.values():
+            for dev_scripts in scripts.values():
+                for (index, script_rd) in enumerate(dev_scripts):
+                    self.script_indexes[id(script_rd)] = index
+
+        self.deliveries = [array("i") for _ in range(num_devices)]
+        self.batches = [array("i") for _ in range(num_devices)]
+        self.lock = Lock()
+        self.tasks = (array("i"), array("i"), array("i"))
+        self.barrier_devices = array("i")
+
+    def delivered(self, device_id, script_rd):
+        """
+        Called by the dispatcher once it assigned a script to a device, with None for the end
+        of the timepoint.
+        """
+        if script_rd is None:
+            self.deliveries[device_id].append(END_OF_TIMEPOINT)
+        else:
+            self.deliveries[device_id].append(self.script_indexes[id(script_rd)])
+
+    def batch_taken(self, device_id, count):
+        """
+        Called by a device thread after it took some assignments from its queue at once.
+        """
+        self.batches[device_id].append(count)
+
+    def task_acquired(self, device_id, timepoint, index):
+        """
+        Called by a pool thread once it holds all the locations of a task.
+        @type index: Integer
+        @param index: the index of the task in the ones of its device for the timepoint
+        """
+        with self.lock:
+            self.tasks[0].append(timepoint)
+            self.tasks[1].append(device_id)
+            self.tasks[2].append(index)
+
+    def barrier_reached(self, device_id):
+        """
+        Called by a device thread right before waiting at the barrier.
+        """
+        with self.lock:
+            self.barrier_devices.append(device_id)
+
+    def log(self):
+        """
+        @rtype: ReplayLog
+        @return: what was recorded, for the data the devices have now
+        """
+        def flatten(lists):
+            offsets = array("i", [0])
+            values = array("i")
+            for values_list in lists:
+                values.extend(values_list)
+                offsets.append(len(values))
+            return offsets, values
+
+        # the threads may still be running, when the log is saved before an abort
+        with self.lock:
+            columns = {"task_timepoints": array("i", self.tasks[0]),
+                       "task_devices": array("i", self.tasks[1]),
+                       "task_indexes": array("i", self.tasks[2]),
+                       "barrier_devices": array("i", self.barrier_devices)}
+        (columns["delivery_offsets"], columns["deliveries"]) = flatten(self.deliveries)
+        (columns["batch_offsets"], columns["batches"]) = flatten(self.batches)
+
+        header = ReplayLog.test_header(self.supervisor.testcase)
+        header["digest"] = data_digest(self.supervisor.devices)
+        return ReplayLog(header, columns)
+
+
+class Replayer(object):
+    """
+    Drives a run to the interleaving of a recorded one:
+        - the dispatcher assigns the scripts of every device in the recorded order, without
+          delays
+        - every device thread takes as many assignments at once as it did
+        - the tasks are not queued in the pool: the pool threads take them in the recorded
+          order, the next one only once the previous one holds its locations
+        - the devices reach the barrier in the recorded order
+    The sleeps of the scripts do not change the result any more, so they are skipped.
+
+    If the run does something the log does not have (a task or a timepoint which was not
+    recorded, more assignments or barrier waits than recorded), the divergence is reported and
+    the rest of the run is not driven any more, so that no thread waits for its turn forever.
+    """
+
+    replaying = True
+
+    def __init__(self, supervisor, log):
+        """
+        Constructor.
+        @type supervisor: supervisor.Supervisor
+        @param supervisor: the supervisor of the run
+        @type log: ReplayLog
+        @param log: the recorded run, of the same test case
+        """
+        self.supervisor = supervisor
+        self.log = log
+
+        # the deliveries of every device, split in timepoints
+        self.deliveries = []
+        for deliveries in log.split("delivery_offsets", "deliveries"):
+            self.deliveries.append([])
+            timepoint = []
+            for index in deliveries:
+                if index == END_OF_TIMEPOINT:
+                    self.deliveries[-1].append(timepoint)
+                    timepoint = []
+                else:
+                    timepoint.append(index)
+        self.batches = [iter(batches) for batches in log.split("batch_offsets", "batches")]
+
+        self.cond = Condition()
+        self.tasks = zip(log.columns["task_timepoints"], log.columns["task_devices"],
+                         log.columns["task_indexes"])
+        self.recorded_tasks = set(self.tasks)
+        self.next_task_index = 0
+        self.ready_tasks = {}
+        # true while the task whose turn it is locks its locations
+        self.locking = False
+        self.stopped = False
+        self.diverged = False
+        self.barrier_devices = log.columns["barrier_devices"]
+        self.next_barrier_index = 0
+
+    def __diverge(self):
+        """
+        Reports the first divergence from the log and releases the threads waiting for their
+        turn; called with the condition held.
+        """
+        if not self.diverged:
+            self.diverged = True
+            self.supervisor.report("replay diverged from log at task %d\n"
+                                   % self.next_task_index, False)
+        self.cond.notify_all()
+
+    def script_batches(self, device_id, timepoint):
+        """
+        @rtype: List of (Float, List of ScriptRunData)
+        @return: the batches of scripts of a device for a timepoint, as
+            supervisor.Supervisor.script_batches: a single one, without delay, with the scripts
+            in the recorded order
+        """
+        scripts = self.supervisor.scripts[timepoint][device_id]
+        deliveries = self.deliveries[device_id]
+        if timepoint < len(deliveries) and sorted(deliveries[timepoint]) == range(len(scripts)):
+            return [(0, [scripts[index] for index in deliveries[timepoint]])]
+
+        with self.cond:
+            self.__diverge()
+        return [(0, scripts)]
+
+    def delivered(self, device_id, script_rd):
+        """
+        Nothing to do, the scripts are assigned as script_batches says.
+        """
+        pass
+
+    def batch_size(self, device_id):
+        """
+        @rtype: Integer
+        @return: the number of assignments a device thread takes at once, one at a time once
+            the run diverged
+        """
+        with self.cond:
+            if not self.diverged:
+                size = next(self.batches[device_id], None)
+                if size is not None:
+                    return size
+                self.__diverge()
+        return 1
+
+    def submit(self, device_id, timepoint, index, task):
+        """
+        Hands a task of the pool to the replayer instead of the queue of the pool.
+        """
+        with self.cond:
+            key = (timepoint, device_id, index)
+            self.ready_tasks[key] = task
+            if key not in self.recorded_tasks:
+                self.__diverge()
+            self.cond.notify_all()
+
+    def next_task(self):
+        """
+        Called by a pool thread to get a task: blocks until it is the turn of a task which was
+        submitted and the previous one holds its locations; once the run diverged, any
+        submitted task.
+        @return: the task, None once the pool is stopped
+        """
+        with self.cond:
+            while not self.stopped:
+                if self.diverged:
+                    if self.ready_tasks:
+                        return self.ready_tasks.popitem()[1]
+                elif self.next_task_index == len(self.tasks):
+                    if self.ready_tasks:
+                        self.__diverge()
+                        continue
+                elif not self.locking:
+                    task = self.ready_tasks.pop(self.tasks[self.next_task_index], None)
+                    if task is not None:
+                        self.locking = True
+                        return task
+                self.cond.wait()
+
+        return None
+
+    def task_acquired(self, device_id, timepoint, index):
+        """
+        Called by a pool thread once it holds all the locations of a task: the next one may
+        start locking.
+        """
+        with self.cond:
+            self.next_task_index += 1
+            self.locking = False
+            self.cond.notify_all()
+
+    def barrier_reached(self, device_id):
+        """
+        Blocks a device thread until the devices which reached the barrier before it did.
+        """
+        with self.cond:
+            while not self.diverged:
+                if self.next_barrier_index == len(self.barrier_devices):
+                    self.__diverge()
+                elif self.barrier_devices[self.next_barrier_index] == device_id:
+                    self.next_barrier_index += 1
+                    self.cond.notify_all()
+                    return
+                else:
+                    self.cond.wait()
+
+    def stop(self):
+        """
+        Releases the pool threads waiting for tasks.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
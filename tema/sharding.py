@@ -0,0 +1,313 @@
+"""
+Testing infrastructure - runs the coroutine runtime in several processes, the devices being
+split in shards and their data kept in a shared_data.SharedSensorTable
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import deque
+
+from coroutines import AsyncBarrier, AsyncQueue, EventLoop, run_device
+from shared_data import SharedSensorTable
+
+# Number of process-shared locks, a script locking the one of its location
+LOCK_STRIPES = 64
+# Longest wait, in seconds, between two attempts to take a lock held by another script
+MAX_BACKOFF = 0.001
+# Interval, in seconds, at which a process waiting at the barrier checks that the others live
+BARRIER_POLL = 0.1
+# The shard processes inherit the runtime (its anonymous table, locks and supervisor) by fork;
+# without it (Windows), they would have to pickle it, so the runtime is not available
+FORK_SUPPORTED = hasattr(os, "fork")
+
+
+class ShardDevice(object):
+    """
+    A device of the sharded runtime, whose data is in a SharedSensorTable, so that any process
+    can read and change it, and whose locations are protected by locks shared by the processes.
+    """
+
+    def __init__(self, loop, device_id, sensor_data, locks):
+        """
+        Constructor.
+        @type loop: EventLoop
+        @param loop: the loop of the process, None if the device is only read
+        @type device_id: Integer
+        @param device_id: the unique id of this node; between 0 and N-1
+        @type sensor_data: shared_data.SharedSensorData
+        @param sensor_data: the data of the device
+        @type locks: List of multiprocessing.Lock
+        @param locks: the locks of the locations, the same for all the devices
+        """
+        self.device_id = device_id
+        self.sensor_data = sensor_data
+        self.locks = locks
+        self.script_queue = AsyncQueue(loop) if loop is not None else None
+        self.scripts = []
+
+    def __str__(self):
+        return "Device %d" % self.device_id
+
+    def lock(self, location):
+        """
+        @rtype: multiprocessing.Lock
+        @return: the lock of a location
+        """
+        return self.locks[location % len(self.locks)]
+
+    def get_data(self, location):
+        """
+        @rtype: Float
+        @return: the pollution value for the given location, None if there is none
+        """
+        if location in self.sensor_data:
+            return self.sensor_data[location]
+        return None
+
+    def set_data(self, location, data):
+        """
+        Sets the pollution value for the given location, if the device has one.
+        """
+        if location in self.sensor_data:
+            self.sensor_data[location] = data
+
+
+class ProcessBarrier(object):
+    """
+    Reusable barrier for processes, like device.ReusableBarrierCond, the counters being in
+    shared memory.
+    """
+
+    def __init__(self, num_processes):
+        self.num_processes = num_processes
+        self.count = multiprocessing.Value("i", 0, lock=False)
+        self.generation = multiprocessing.Value("i", 0, lock=False)
+        self.cond = multiprocessing.Condition()
+
+    def wait(self, failed=None):
+        """
+        Wait for the other processes.
+        @type failed: Function
+        @param failed: called every BARRIER_POLL seconds while waiting, a true result meaning
+            that some process will never arrive
+        @rtype: Boolean
+        @return: true once all the processes arrived, false if failed stopped the wait
+        """
+        with self.cond:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.num_processes:
+                self.count.value = 0
+                self.generation.value += 1
+                self.cond.notify_all()
+                return True
+
+            while generation == self.generation.value:
+                self.cond.wait(BARRIER_POLL if failed is not None else None)
+                if generation == self.generation.value and failed is not None and failed():
+                    return False
+
+        return True
+
+
+def run_shared_script(loop, device, neighbours, script_rd):
+    """
+    Coroutine running a script on shared data, with the parameters of coroutines.run_script.
+    The lock of the location may be held by a script of another process, so it is only tried:
+    while it is taken, the coroutine sleeps and the loop runs the others.
+    """
+    # pylint: disable=protected-access
+    location = script_rd.location
+    devices = {dev.device_id : dev for dev in neighbours}
+    devices[device.device_id] = device
+    holders = [devices[dev_id] for dev_id in sorted(devices)
+               if location in devices[dev_id].sensor_data]
+    if not holders:
+        return
+
+    lock = device.lock(location)
+    backoff = 0
+    while not lock.acquire(False):
+        yield loop.sleep(backoff)
+        backoff = min(2 * backoff or MAX_BACKOFF / 64, MAX_BACKOFF)
+
+    try:
+        delay = script_rd.script._Script__delay
+        if delay is not None:
+            yield loop.sleep(random.uniform(delay[0], delay[1]))
+
+        result = script_rd.script._Script__update([dev.sensor_data[location] for dev in holders])
+        for dev in holders:
+            dev.sensor_data[location] = result
+    finally:
+        lock.release()
+
+
+def partition(testcase, num_shards):
+    """
+    Splits the devices in shards of (almost) the same size, keeping the devices which share
+    locations together: the devices are visited breadth first over the shared locations and
+    each one goes to the shard holding the most devices it shares locations with, weighted by
+    how much room the shard has left.
+
+    @type testcase: test.TestCase
+    @param testcase: the test case
+    @type num_shards: Integer
+    @param num_shards: the number of shards
+    @rtype: List of List of Integer
+    @return: the ids of the devices of every shard
+    """
+    locations = {dev.id : [loc.id for loc in dev.locations] for dev in testcase.devices}
+    devices_for_locations = {}
+    for (dev_id, dev_locations) in locations.items():
+        for loc in dev_locations:
+            devices_for_locations.setdefault(loc, []).append(dev_id)
+
+    capacity = (len(locations) + num_shards - 1) // num_shards
+    shards = [[] for _ in range(num_shards)]
+    shard_of = {}
+
+    for first in sorted(locations):
+        if first in shard_of:
+            continue
+
+        visit = deque([first])
+        seen = set(visit)
+        while visit:
+            dev_id = visit.popleft()
+
+            shared = [0] * num_shards
+            for loc in locations[dev_id]:
+                for other in devices_for_locations[loc]:
+                    if other in shard_of:
+                        shared[shard_of[other]] += 1
+                    elif other not in seen:
+                        seen.add(other)
+                        visit.append(other)
+
+            best = max((shard for shard in range(num_shards) if len(shards[shard]) < capacity),
+                       key=lambda shard: (shared[shard] * (1 - len(shards[shard]) / float(capacity)),
+                                          -len(shards[shard])))
+            shards[best].append(dev_id)
+            shard_of[dev_id] = best
+
+    return [shard for shard in shards if shard]
+
+
+class ShardedRuntime(object):
+    """
+    Runs the test case of a supervisor in several processes, each one running the coroutines of
+    the devices in its shard. The data is in a SharedSensorTable, backed by the data file of
+    the test case if it has one, and the shards end every timepoint together, at a
+    ProcessBarrier.
+    """
+
+    def __init__(self, supervisor, num_shards):
+        """
+        Splits the devices and puts their data in shared memory. The devices, which the
+        supervisor validates, read the shared table.
+        @type supervisor: supervisor.Supervisor
+        @param supervisor: the supervisor of the test case
+        @type num_shards: Integer
+        @param num_shards: the number of processes
+        """
+        self.supervisor = supervisor
+        testcase = supervisor.testcase
+
+        self.table = SharedSensorTable.create(testcase.devices,
+                                              supervisor.iteration_filename(testcase.data_file))
+        self.locks = [multiprocessing.Lock() for _ in range(LOCK_STRIPES)]
+
+        self.devices = {dev.id : ShardDevice(None, dev.id, self.table.device_data(dev.id),
+                                             self.locks)
+                        for dev in testcase.devices}
+        self.shards = partition(testcase, max(1, min(num_shards, len(self.devices))))
+
+        # with timepoint checks, this process validates between two barriers
+        self.barrier = ProcessBarrier(len(self.shards) + (1 if testcase.check_timepoints else 0))
+        self.parent_pid = os.getpid()
+
+    def orphaned(self):
+        """
+        @rtype: Boolean
+        @return: true in a shard process whose supervisor process died
+        """
+        return os.getppid() != self.parent_pid
+
+    def end_timepoint(self):
+        """
+        Called in a shard process once all its devices ended the timepoint. The shard exits if
+        the supervisor dies meanwhile; if another shard dies, the supervisor stops this one.
+        """
+        if not self.barrier.wait(self.orphaned):
+            sys.exit(1)
+        if self.supervisor.testcase.check_timepoints:
+            # the supervisor validates the timepoint
+            if not self.barrier.wait(self.orphaned):
+                sys.exit(1)
+
+    def run_shard(self, shard):
+        """
+        Main function of a shard process.
+        @type shard: Integer
+        @param shard: the index of the shard
+        """
+        # the processes must not draw the same delays
+        random.seed()
+
+        loop = EventLoop()
+        devices = {dev_id : ShardDevice(loop, dev_id, device.sensor_data, self.locks)
+                   for (dev_id, device) in self.devices.items()}
+        barrier = AsyncBarrier(loop, len(self.shards[shard]), self.end_timepoint)
+
+        for dev_id in self.shards[shard]:
+            loop.spawn(run_device(loop, self.supervisor, devices[dev_id], devices, barrier,
+                                  run_shared_script))
+
+        loop.run()
+
+    def run(self):
+        """
+        Runs the shard processes until every device ends its last timepoint.
+        @rtype: List of String
+        @return: the errors of the processes
+        """
+        testcase = self.supervisor.testcase
+        processes = [multiprocessing.Process(target=self.run_shard, args=(shard,),
+                                             name="Shard %d" % shard)
+                     for shard in range(len(self.shards))]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        def failed():
+            return ["%s failed with exit code %d" % (process.name, process.exitcode)
+                    for process in processes if process.exitcode not in (None, 0)]
+
+        # a failed shard leaves the others, and this process, waiting at the barrier
+        if testcase.check_timepoints:
+            for crt_timepoint in range(testcase.duration + testcase.extra_duration):
+                if not self.barrier.wait(failed):
+                    break
+                self.supervisor.validate_bounds(crt_timepoint)
+                if not self.barrier.wait(failed):
+                    break
+
+        errors = failed()
+        while any(process.is_alive() for process in processes) and not errors:
+            time.sleep(0.01)
+            errors = failed()
+
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        return errors
@@ -0,0 +1,178 @@
+"""
+Testing infrastructure - the sensor data of all the devices in shared memory, which other
+processes can map and read without copying
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+import ctypes
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+
+# Layout of the table: the header, the offsets of the slots of every device (device d has
+# the slots offsets[d] to offsets[d + 1] - 1), the location id of every slot (sorted for
+# every device) and the value of every slot
+MAGIC = "SENSDATA"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")   # magic, version, padding, devices, slots
+
+
+class SharedSensorTable(object):
+    """
+    The sensor data of all the devices as a packed table in an mmap: anonymous, inherited by
+    the processes forked after its creation, or backed by a file, which any process can open.
+    """
+
+    def __init__(self, memory):
+        """
+        Maps the table in the given memory; use create or open.
+        @type memory: mmap.mmap
+        @param memory: the memory holding the table
+        """
+        self.memory = memory
+        (magic, version, _, num_devices, num_slots) = HEADER.unpack_from(memory, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a sensor data table")
+
+        self.num_devices = num_devices
+        self.num_slots = num_slots
+        offset = HEADER.size
+        self.offsets = (ctypes.c_int64 * (num_devices + 1)).from_buffer(memory, offset)
+        offset += ctypes.sizeof(self.offsets)
+        self.locations = (ctypes.c_int64 * num_slots).from_buffer(memory, offset)
+        offset += ctypes.sizeof(self.locations)
+        self.values = (ctypes.c_double * num_slots).from_buffer(memory, offset)
+
+    @staticmethod
+    def size(num_devices, num_slots):
+        """
+        @rtype: Integer
+        @return: the size in bytes of a table
+        """
+        return HEADER.size + 8 * (num_devices + 1) + 16 * num_slots
+
+    @staticmethod
+    def create(devices, filename=None):
+        """
+        Creates a table with the initial data of the devices.
+        @type devices: List of test.DeviceTestData
+        @param devices: the devices of the test case
+        @type filename: String
+        @param filename: the file backing the table, replaced; None for anonymous memory
+        @rtype: SharedSensorTable
+        @return: the table
+        """
+        sensor_data = {dev.id : sorted(dev.locations) for dev in devices}
+        num_devices = max(sensor_data) + 1 if sensor_data else 0
+        num_slots = sum(len(locations) for locations in sensor_data.values())
+        size = SharedSensorTable.size(num_devices, num_slots)
+
+        if filename is None:
+            memory = mmap.mmap(-1, size)
+        else:
+            # a new file takes the place of the old one, which may still be mapped by a
+            # process, instead of truncating it
+            new_filename = "%s.%d" % (filename, os.getpid())
+            with open(new_filename, "w+b") as table_file:
+                table_file.truncate(size)
+                memory = mmap.mmap(table_file.fileno(), size)
+            os.rename(new_filename, filename)
+        HEADER.pack_into(memory, 0, MAGIC, VERSION, 0, num_devices, num_slots)
+
+        table = SharedSensorTable(memory)
+        slot = 0
+        for device_id in range(num_devices):
+            table.offsets[device_id] = slot
+            for (loc, data) in sensor_data.get(device_id, ()):
+                table.locations[slot] = loc
+                table.values[slot] = data
+                slot += 1
+        table.offsets[num_devices] = slot
+
+        return table
+
+    @staticmethod
+    def open(filename):
+        """
+        Maps the table of a file, created by another process.
+        @type filename: String
+        @param filename: the file backing the table
+        @rtype: SharedSensorTable
+        @return: the table, sharing its memory with the other processes
+        """
+        with open(filename, "r+b") as table_file:
+            memory = mmap.mmap(table_file.fileno(), os.fstat(table_file.fileno()).st_size)
+        return SharedSensorTable(memory)
+
+    def device_data(self, device_id):
+        """
+        @rtype: SharedSensorData
+        @return: the data of a device, as a dictionary of its locations
+        """
+        return SharedSensorData(self, device_id)
+
+
+class SharedSensorData(object):
+    """
+    The data of a device in a SharedSensorTable, with the dictionary operations used by
+    Device, like device.ArraySensorData: the slot of a location is found by a binary search
+    in the location ids of the device.
+    """
+
+    def __init__(self, table, device_id):
+        self.__locations = table.locations
+        self.__values = table.values
+        self.__start = table.offsets[device_id]
+        self.__end = table.offsets[device_id + 1]
+
+    def __slot(self, location):
+        slot = bisect_left(self.__locations, location, self.__start, self.__end)
+        if slot == self.__end or self.__locations[slot] != location:
+            return None
+        return slot
+
+    def __contains__(self, location):
+        return self.__slot(location) is not None
+
+    def __getitem__(self, location):
+        slot = self.__slot(location)
+        if slot is None:
+            raise KeyError(location)
+        return self.__values[slot]
+
+    def __setitem__(self, location, data):
+        slot = self.__slot(location)
+        if slot is None:
+            raise KeyError(location)
+        self.__values[slot] = data
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __iter__(self):
+        return iter(self.__locations[self.__start:self.__end])
+
+
+def main():
+    """
+    Prints the data of a table file, for all the devices or the given ones.
+    """
+    if len(sys.argv) < 2:
+        print "Usage: python %s <table file> [device id]..." % sys.argv[0]
+        sys.exit(2)
+
+    table = SharedSensorTable.open(sys.argv[1])
+    device_ids = [int(arg) for arg in sys.argv[2:]] or range(table.num_devices)
+    for device_id in device_ids:
+        sensor_data = table.device_data(device_id)
+        print "Device %d: %s" % (device_id, ", ".join("%d=%g" % (loc, sensor_data[loc])
+                                                      for loc in sensor_data))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ Assignment 1
 March 2019
 """
 
+import heapq
+import itertools
 import os
 import random
 import sys
@@ -13,13 +15,24 @@ import time
 import threading
 
 from collections import namedtuple
-from device import Device
+from coroutines import CoroutineRuntime, RUNTIME_COROUTINES, RUNTIME_SHARDED
+from device import Device, LockMetrics, HISTOGRAM_BOUNDS, STORAGE_SHARED
+from multiprocessing import cpu_count
+from reference import create_reference
+from replay import data_digest, Recorder, Replayer, ReplayLog
+from shared_data import SharedSensorTable
+from sharding import ShardedRuntime
+from tracing import Tracer
 from random import shuffle, uniform
-from threading import current_thread, Event, Semaphore, Thread
+from threading import current_thread, Condition, Event, Thread
 from time import sleep
 from traceback import print_stack
 
 
+# Number of locations listed in the lock contention report
+LOCK_REPORT_SIZE = 10
+
+
 class Supervisor(object):
     """
     Class used to globally check accesses from device threads and verify result
@@ -44,17 +57,34 @@ class Supervisor(object):
         self.setup_event = Event()
         self.start_event = Event()
         self.devices = {}
-        self.threads = {}
-        self.waits = {}
+        self.dispatcher = ScriptDispatcher()
         self.die_on_error = die_on_error
         self.banned_threads = set()
         self.messages = []
+        self.timepoint_starts = {}
+        # the number of live threads when every timepoint started, right after the barrier
+        self.timepoint_threads = {}
         self.scripts = {i : {j : [] for j in range(len(self.testcase.devices))} for i in range(self.testcase.duration + self.testcase.extra_duration)}
         for script_td in self.testcase.scripts:
-            script = Script(self.testcase.script_sleep)
+            # a replayed run does not depend on the sleeps any more
+            zero_delay = self.testcase.zero_delay or self.testcase.replay_file is not None
+            script = Script((0, 0) if zero_delay else self.testcase.script_sleep)
             script._Script__set_supervisor(self)
             self.scripts[script_td.time_point][script_td.device].append(ScriptRunData(script=script, location=script_td.location))
 
+        # neighbour ids (and, once created, neighbour devices) for each (device id, timepoint)
+        self.neighbour_ids = Supervisor.__index_encounters(self.testcase.devices)
+        self.neighbours = {}
+
+        # reference model used for validation, advanced one timepoint at a time
+        self.reference = create_reference(self.testcase.reference, self.testcase,
+                                          self.scripts, self.neighbour_ids)
+
+        # used to validate the data after every timepoint, if the testcase asks for it
+        self.check_cond = Condition()
+        self.check_count = 0
+        self.check_generation = 0
+
     def register_banned_thread(self, thread=None):
         """
         !!! This is not part of the assignment API, do not call it !!!
@@ -106,52 +136,47 @@ tester thread '%s'" % (str(device), method, thread.name))
 
         Validates the current state of the data.
         """
-        data = {}
-        for device_testdata in self.testcase.devices:
-            device_id = device_testdata.id
-            sensor_data = {loc : data for (loc, data) in device_testdata.locations}
-            data[device_id] = sensor_data
-
-        for tpt in range(crt_timepoint + 1):
-            # print "timepoint %d" % tpt
-            # for (dev, dat) in data.items():
-            #     print "dev: %d %s" % (dev, str(dat))
-
-            for run_tpt in range(tpt + 1):
-                for (dev, scripts) in self.scripts[run_tpt].items():
-                    for script_rd in scripts:
-                        scrpt = script_rd.script
-                        location = script_rd.location
-                        neighbour_ids = self.__compute_neighbour_ids(dev, tpt)
-
-                        # print "dev: %d %s" % (dev, neighbour_ids)
-
-                        script_data = []
-                        # collect data from current neighbours
-                        for neigh in neighbour_ids:
-                            if location in data[neigh]:
-                                script_data.append(data[neigh][location])
-                        # add our data, if any
-                        if location in data[dev]:
-                            script_data.append(data[dev][location])
-
-                        # run script on data
-                        if script_data != []:
-                            result = scrpt._Script__update(script_data)
-
-                            # update data of neighbours
-                            for neigh in neighbour_ids:
-                                if location in data[neigh]:
-                                    data[neigh][location] = result
-                            # update our data
-                            if location in data[dev]:
-                                data[dev][location] = result
-
-        for (dev_id, sens_data) in data.items():
-            for (loc, ref_data) in sens_data.items():
-                calc_data = self.devices[dev_id].device.get_data(loc)
-                if ref_data != calc_data:
-                    self.report("after timepoint %d, data for location %d on device %d differs: expected %f, found %f\n" % (crt_timepoint, loc, dev_id, ref_data, calc_data))
+        self.reference.advance(crt_timepoint)
+
+        for (dev_id, loc, ref_data, _, _) in self.reference.values():
+            calc_data = self.devices[dev_id].device.get_data(loc)
+            if ref_data != calc_data:
+                self.report("after timepoint %d, data for location %d on device %d differs: expected %f, found %f\n" % (crt_timepoint, loc, dev_id, ref_data, calc_data))
+
+    def validate_bounds(self, crt_timepoint):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Validates the state of the data while the devices are still running: every value must be
+        between the bounds computed by the reference model, whatever the order of the scripts.
+        """
+        self.reference.advance(crt_timepoint)
+
+        for (dev_id, loc, _, low, high) in self.reference.values():
+            calc_data = self.devices[dev_id].device.get_data(loc)
+            if calc_data < low or calc_data > high:
+                self.report("after timepoint %d, data for location %d on device %d is wrong: expected between %f and %f, found %f\n" % (crt_timepoint, loc, dev_id, low, high, calc_data))
+
+    def __check_timepoint(self, crt_timepoint):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Blocks the devices asking for the neighbours of a new timepoint until all of them have
+        asked, then the last one validates the data of the previous timepoint. At this point all
+        the scripts of the previous timepoint have finished and none of the current one started.
+        """
+        with self.check_cond:
+            generation = self.check_generation
+            self.check_count += 1
+            if self.check_count == len(self.devices):
+                if crt_timepoint > 0:
+                    self.validate_bounds(crt_timepoint - 1)
+                self.check_count = 0
+                self.check_generation += 1
+                self.check_cond.notify_all()
+            else:
+                while generation == self.check_generation:
+                    self.check_cond.wait()
 
     def report(self, message, die_on_error=None):
         """
@@ -169,10 +194,25 @@ tester thread '%s'" % (str(device), method, thread.name))
         if die_on_error:
             print >> sys.stderr, message + "\n",
             print_stack()
+            # the recording of the failed run is what can reproduce it
+            self.save_recording()
             os.abort()
 
         self.messages.append(message)
 
+    def save_recording(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Saves the replay log of the run, if it is recorded, in the record file of the current
+        iteration. Also called before aborting, the log then ending where the run stopped; the
+        recording ends, so that it is saved once.
+        """
+        replay = Device.replay
+        if replay is not None and not replay.replaying:
+            Device.replay = None
+            replay.log().save(self.iteration_filename(self.testcase.record_file))
+
     def status(self):
         """
         !!! This is not part of the assignment API, do not call it !!!
@@ -190,28 +230,23 @@ tester thread '%s'" % (str(device), method, thread.name))
         device.setup_devices(neighbours)
     
     @staticmethod
-    def __send_scripts(device, scripts, delay, wait):
-        time.sleep(delay)
-        for script_rd in scripts:
-            if script_rd is scripts[-1]:
-                time.sleep(delay)
-            device.assign_script(script_rd.script, script_rd.location)
-        wait.release()
+    def __index_encounters(devices):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
 
-    @staticmethod
-    def __send_end(device, wait, count):
-        for i in range(count):
-            wait.acquire()
-        device.assign_script(None, None)
-
-    def __compute_neighbour_ids(self, device_id, time_point):
-        neighbours = set()
-        # ugly linear search is ugly
-        for enc in self.testcase.devices[device_id].encounters:
-            if enc.time_point != time_point:
-                continue
-            neighbours |= set(enc.devices)
-        return list(neighbours)
+        Builds the neighbour index used by the runtime and by the validation.
+
+        @type devices: List of test.DeviceTestData
+        @param devices: the devices of the test case
+        @rtype: Dictionary of (Integer, Integer) to Tuple of Integer
+        @return: the ids of the neighbours for each (device id, timepoint) with encounters
+        """
+        index = {}
+        for device_testdata in devices:
+            for enc in device_testdata.encounters:
+                key = (device_testdata.id, enc.time_point)
+                index.setdefault(key, set()).update(enc.devices)
+        return {key : tuple(neighbours) for (key, neighbours) in index.items()}
 
     def get_neighbours(self, device_id):
         """
@@ -233,14 +268,24 @@ tester thread '%s'" % (str(device), method, thread.name))
         device = self.devices[device_id].device
         crt_timepoint = self.devices[device_id].crt_timepoint
 
+        # the first device asking for its neighbours starts the timepoint
+        start = time.time()
+        if self.timepoint_starts.setdefault(crt_timepoint, start) is start:
+            self.timepoint_threads[crt_timepoint] = threading.active_count()
+            if Device.tracer is not None:
+                Device.tracer.instant("timepoint start", device_id, crt_timepoint)
+
         self.check_execution("get_neighbours", device)
 
+        if self.testcase.check_timepoints:
+            self.__check_timepoint(crt_timepoint)
+
         for dev_rd in self.devices.values():
             if dev_rd.crt_timepoint < crt_timepoint or dev_rd.crt_timepoint > crt_timepoint + 1:
                 self.report("device %d called 'get_neighbours' without waiting for other devices\n" % device_id, True)
 
-        for thrd in self.threads[device_id]:
-                    thrd.join()
+        # the scripts of the previous timepoint have all been delivered
+        self.dispatcher.wait_delivered(device_id)
 
         if crt_timepoint == self.testcase.duration + self.testcase.extra_duration:
             return None
@@ -248,42 +293,108 @@ tester thread '%s'" % (str(device), method, thread.name))
         if crt_timepoint > self.testcase.duration + self.testcase.extra_duration:
             self.report("called 'get_neighbours' from device %d, on timepoint %d, after simulation end at %d\n" % (device_id, crt_timepoint, self.testcase.duration + self.testcase.extra_duration), True)
 
-        neighbour_ids = self.__compute_neighbour_ids(device_id, crt_timepoint)
-
-        neighbours = [self.devices[neigh_id].device for neigh_id in neighbour_ids]
+        neighbours = list(self.neighbours.get((device_id, crt_timepoint), ()))
 
         scripts = self.scripts[crt_timepoint][device_id]
 
         for scrpt in scripts:
             scrpt.script._Script__set_device(device)
 
+        self.dispatcher.schedule(device, self.script_batches(device_id, crt_timepoint))
+
+        self.devices[device_id].crt_timepoint = crt_timepoint + 1
+
+        return neighbours
+
+    def lock_report(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Summarizes the lock metrics of the devices, for the locations where the scripts waited
+        the most.
+
+        @rtype: List of String
+        @return: the lines of the report
+        """
+        locations = {}
+        for (dev_id, dev_rd) in self.devices.items():
+            for (loc, metrics) in dev_rd.device.locks.metrics().items():
+                if metrics.acquisitions > 0:
+                    locations.setdefault(loc, []).append((metrics.wait_time, dev_id, metrics))
+
+        hottest = []
+        for (loc, devices) in locations.items():
+            total = LockMetrics()
+            for (_, _, metrics) in devices:
+                total.add(metrics)
+            hottest.append((total.wait_time, loc, total, max(devices)))
+        hottest.sort(reverse=True)
+
+        def bound(histogram, fraction):
+            value = LockMetrics.percentile(histogram, fraction)
+            if value is None:
+                return ">%.0fus" % (HISTOGRAM_BOUNDS[-1] * 1e6)
+            return "<=%.0fus" % (value * 1e6)
+
+        lines = ["Hottest locations (by the time spent waiting for their locks):"]
+        for (_, loc, total, (_, dev_id, metrics)) in hottest[:LOCK_REPORT_SIZE]:
+            lines.append("location %d: %d acquisitions, %d waited, %.3fs waiting (p50 %s, p99 %s), "
+                         "%.3fs held (p50 %s, p99 %s), most on device %d (%.3fs)"
+                         % (loc, total.acquisitions, total.contended, total.wait_time,
+                            bound(total.wait_histogram, 0.5), bound(total.wait_histogram, 0.99),
+                            total.hold_time,
+                            bound(total.hold_histogram, 0.5), bound(total.hold_histogram, 0.99),
+                            dev_id, metrics.wait_time))
+
+        return lines
+
+    def iteration_filename(self, filename):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        @type filename: String
+        @param filename: a file of the test case, like its trace file
+        @rtype: String
+        @return: the file used by the current iteration, the iteration number being added to its
+            name when there are several; None if filename is None
+        """
+        if filename is None or self.testcase.num_iterations is None or \
+                self.testcase.num_iterations == 1:
+            return filename
+
+        root, ext = os.path.splitext(filename)
+        return "%s-%d%s" % (root, self.testcase.crt_iteration, ext)
+
+    def script_batches(self, device_id, crt_timepoint):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Splits the scripts a device receives in a timepoint in batches, each one delivered
+        after its own delay: a batch for every script if the test case has parallel scripts,
+        else a single batch.
+
+        @rtype: List of (Float, List of ScriptRunData)
+        @return: the delay and the scripts of every batch
+        """
+        if Device.replay is not None and Device.replay.replaying:
+            return Device.replay.script_batches(device_id, crt_timepoint)
+
+        scripts = self.scripts[crt_timepoint][device_id]
+
         if self.testcase.parallel_script:
             scripts = [[script] for script in scripts]
         else:
             scripts = [scripts]
 
-        self.waits[device_id] = Semaphore(0)
-
-        self.threads[device_id] = []
+        batches = []
         for scrpt in scripts:
             delay_min = self.testcase.script_delay[0]
             delay_max = self.testcase.script_delay[1]
-            thread = Thread(name="Sender",
-                            target=Supervisor.__send_scripts,
-                            args=(device, scrpt, random.uniform(delay_min, delay_max), self.waits[device_id]))
-            self.register_banned_thread(thread)
-            self.threads[device_id].append(thread)
-            thread.start()
-
-        thread = Thread(name="Ender",
-                        target=Supervisor.__send_end,
-                        args=(device, self.waits[device_id], len(scripts)))
-        self.threads[device_id].append(thread)
-        thread.start()
+            if self.testcase.zero_delay:
+                delay_min = delay_max = 0
+            batches.append((random.uniform(delay_min, delay_max), scrpt))
 
-        self.devices[device_id].crt_timepoint = crt_timepoint + 1
-
-        return neighbours
+        return batches
 
     def run_testcase(self):
         """
@@ -295,13 +406,46 @@ tester thread '%s'" % (str(device), method, thread.name))
         @rtype: Integer
         @return: the number of errors
         """
+        if self.testcase.runtime == RUNTIME_COROUTINES:
+            return self.__run_coroutines()
+        if self.testcase.runtime == RUNTIME_SHARDED:
+            return self.__run_sharded()
+
+        if self.testcase.replay_file is not None:
+            try:
+                log = ReplayLog.load(self.testcase.replay_file)
+            except StandardError as error:
+                log = None
+                self.report("%s\n" % error, False)
+            if log is not None and \
+                    log.header != dict(log.header, **ReplayLog.test_header(self.testcase)):
+                self.report("%s was not recorded for test %s\n"
+                            % (self.testcase.replay_file, self.testcase.name), False)
+            if self.status():
+                print >> sys.stderr, self.status()[-1]
+                return len(self.status())
+            Device.replay = Replayer(self, log)
+        elif self.testcase.record_file is not None:
+            Device.replay = Recorder(self)
+
+        # the device threads look at the tracer when they start
+        if self.testcase.trace_file is not None:
+            Device.tracer = Tracer()
+        Device.lock_metrics = self.testcase.lock_report
+        Device.storage = self.testcase.storage
+        if Device.storage == STORAGE_SHARED:
+            Device.shared_table = SharedSensorTable.create(
+                self.testcase.devices, self.iteration_filename(self.testcase.data_file))
+
         for device_testdata in self.testcase.devices:
             device_id = device_testdata.id
             sensor_data = {loc : data for (loc, data) in device_testdata.locations}
             supervisor = Runtime(self, device_id)
             device = Device(device_id, sensor_data, supervisor)
             self.devices[device_id] = DeviceRunData(device=device, crt_timepoint=0)
-            self.threads[device_id] = []
+
+        for (key, neighbour_ids) in self.neighbour_ids.items():
+            self.neighbours[key] = tuple(self.devices[neigh_id].device for neigh_id in neighbour_ids)
 
         devices = [device_rd.device for device_rd in self.devices.values()]
         setup_threads = []
@@ -318,11 +462,61 @@ tester thread '%s'" % (str(device), method, thread.name))
         for thread in setup_threads:
             thread.join()
 
+        self.register_banned_thread(self.dispatcher.thread)
+        self.dispatcher.thread.start()
+
         self.start_event.set()
 
         for dev in self.devices.values():
             dev.device.shutdown()
 
+        self.dispatcher.stop()
+
+        if Device.tracer is not None:
+            Device.tracer.export(self.iteration_filename(self.testcase.trace_file))
+            Device.tracer = None
+
+        if Device.lock_metrics:
+            for line in self.lock_report():
+                print >> sys.stderr, line
+            Device.lock_metrics = False
+        Device.shared_table = None
+
+        self.check_termination()
+
+        self.validate(self.testcase.duration + self.testcase.extra_duration - 1)
+
+        if Device.replay is not None:
+            if Device.replay.replaying:
+                # a diverged replay was already reported
+                if not Device.replay.diverged and \
+                        data_digest(self.devices) != Device.replay.log.header["digest"]:
+                    self.report("the replayed data differs from the recorded one\n", False)
+            else:
+                self.save_recording()
+            Device.replay = None
+
+        for msg in self.status():
+            print >> sys.stderr, msg
+
+        return len(self.status())
+
+    def __run_coroutines(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Runs the test case with the coroutine runtime instead of the device threads, validating
+        the data the same way.
+
+        @rtype: Integer
+        @return: the number of errors
+        """
+        runtime = CoroutineRuntime(self)
+        for (device_id, device) in runtime.devices.items():
+            self.devices[device_id] = DeviceRunData(device=device, crt_timepoint=0)
+
+        runtime.run()
+
         self.check_termination()
 
         self.validate(self.testcase.duration + self.testcase.extra_duration - 1)
@@ -332,6 +526,176 @@ tester thread '%s'" % (str(device), method, thread.name))
 
         return len(self.status())
 
+    def __run_sharded(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Runs the test case with the coroutine runtime split in several processes, validating
+        the data in shared memory the same way.
+
+        @rtype: Integer
+        @return: the number of errors
+        """
+        runtime = ShardedRuntime(self, self.testcase.shards or cpu_count())
+        for (device_id, device) in runtime.devices.items():
+            self.devices[device_id] = DeviceRunData(device=device, crt_timepoint=0)
+
+        errors = runtime.run()
+        for error in errors:
+            self.report(error, die_on_error=False)
+
+        self.check_termination()
+
+        if not errors:
+            self.validate(self.testcase.duration + self.testcase.extra_duration - 1)
+
+        for msg in self.status():
+            print >> sys.stderr, msg
+
+        return len(self.status())
+
+
+class ScriptDispatcher(object):
+    """
+    !!! This is not part of the assignment API, do not use it !!!
+
+    Delivers the scripts of all the devices from a single thread, at their scheduled times: the
+    deliveries wait in a heap ordered by time (and by scheduling order, for the same time).
+
+    Each batch of scripts of a device has a delay: all the scripts but the last one are assigned
+    after it, the last one after twice the delay. Once all the batches of a device are delivered,
+    the end of its timepoint is assigned.
+    """
+
+    def __init__(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Creates the dispatcher, its thread is started by the caller.
+        """
+        self.cond = Condition()
+        self.heap = []
+        self.order = itertools.count()
+        # the number of batches still to be delivered, for each device id
+        self.pending = {}
+        self.stopped = False
+        self.thread = Thread(name="Dispatcher", target=self.run)
+
+    def schedule(self, device, batches):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Schedules the scripts of a device for the current timepoint.
+
+        @type device: device.Device
+        @param device: the device which receives the scripts
+        @type batches: List of (Float, List of ScriptRunData)
+        @param batches: the delay and the scripts of every batch
+        """
+        # no batches means the end of the timepoint is assigned right away
+        if not batches:
+            batches = [(0, [])]
+
+        now = time.time()
+        with self.cond:
+            self.pending[device.device_id] = len(batches)
+            for (delay, scripts) in batches:
+                if len(scripts) > 1:
+                    self.__push(now + delay, device, scripts[:-1], False)
+                if scripts:
+                    self.__push(now + 2 * delay, device, scripts[-1:], True)
+                else:
+                    self.__push(now + delay, device, [], True)
+            self.cond.notify_all()
+
+    def __push(self, due, device, scripts, last):
+        heapq.heappush(self.heap, (due, next(self.order), device, scripts, last))
+
+    def wait_delivered(self, device_id):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Blocks until all the scripts scheduled for a device, and the end of its timepoint, were
+        assigned.
+        """
+        with self.cond:
+            while self.pending.get(device_id, 0) > 0:
+                self.cond.wait()
+
+    def stop(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Stops the dispatcher thread, dropping what was not delivered yet.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def run(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Main loop of the dispatcher thread.
+        """
+        while True:
+            with self.cond:
+                due = self.__wait_due()
+                if due is None:
+                    return
+
+            # the scripts are assigned without holding the lock, so an assign_script which
+            # blocks does not block schedule and wait_delivered, called by the devices
+            for (_, _, device, scripts, _) in due:
+                for script_rd in scripts:
+                    device.assign_script(script_rd.script, script_rd.location)
+                    if Device.replay is not None:
+                        Device.replay.delivered(device.device_id, script_rd)
+
+            ended = []
+            with self.cond:
+                for (_, _, device, _, last) in due:
+                    if last:
+                        self.pending[device.device_id] -= 1
+                        if self.pending[device.device_id] == 0:
+                            ended.append(device)
+
+            for device in ended:
+                device.assign_script(None, None)
+                if Device.replay is not None:
+                    Device.replay.delivered(device.device_id, None)
+
+            if ended:
+                with self.cond:
+                    self.cond.notify_all()
+
+    def __wait_due(self):
+        """
+        !!! This is not part of the assignment API, do not call it !!!
+
+        Waits, holding the lock, until some deliveries are due and takes them from the heap.
+
+        @rtype: List of Tuple
+        @return: the due heap entries, in order; None once the dispatcher is stopped
+        """
+        while not self.stopped:
+            if not self.heap:
+                self.cond.wait()
+                continue
+
+            now = time.time()
+            if self.heap[0][0] > now:
+                self.cond.wait(self.heap[0][0] - now)
+                continue
+
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+            return due
+
+        return None
+
 
 class Runtime(object):
     """
@@ -6,10 +6,21 @@ Assignment 1
 March 2019
 """
 
+import hashlib
+import json
+import mmap
 import os
+import random
 import re
+import struct
+import sys
+from array import array
 from collections import namedtuple
 
+from coroutines import RUNTIME_THREADS
+from device import STORAGE_DICT
+from reference import REFERENCE_DICT
+
 # TestCase parameters, the same string as in the test* file format
 TESTCASE_NAME = "name"
 NUM_DEVICES = "num_nodes"
@@ -29,6 +40,21 @@ SCRIPT_ASSIGNMENT_RANDOM = "RANDOM"
 SCRIPT_ASSIGNMENT_ALL = "ALL"
 SCRIPT_ASSIGNMENT_SINGLE = "SINGLE"
 
+# Changes whenever the generator draws different test cases for the same
+# parameters and seed, so that saved test cases are not reused
+GENERATOR_VERSION = 1
+
+# Binary test case files: the magic string, followed by the length of a JSON
+# header (the parameters and where each column is) and by the columns, every
+# one a packed array starting at a multiple of COLUMN_ALIGNMENT
+BINARY_MAGIC = "TESTCASE"
+BINARY_VERSION = 1
+COLUMN_ALIGNMENT = 8
+HEADER_LENGTH = struct.Struct("<Q")
+# the scalar attributes of a TestCase kept in the header
+BINARY_ATTRIBUTES = ["name", "num_locations", "duration", "extra_duration", "script_delay",
+                     "script_sleep", "parallel_script", "timeout", "run_seed"]
+
 Location = namedtuple("Location", ['id', 'sensor_data'])
 Encounter = namedtuple("Encounter", ['time_point', 'devices'])
 DeviceTestData = namedtuple("DeviceTestData", ['id', 'locations', 'encounters'])
@@ -53,6 +79,30 @@ class TestCase(object):
         self.timeout = None
         self.num_iterations = None
         self.crt_iteration = None
+        self.check_timepoints = False
+        # sleep(0) instead of the script sleeps and delays: threads still yield
+        # where they would sleep, but the run is not dominated by sleeping
+        self.zero_delay = False
+        # the kind of reference model used for validation, see reference.REFERENCES
+        self.reference = REFERENCE_DICT
+        # Chrome trace JSON file in which the events of the run are written, None for no tracing
+        self.trace_file = None
+        # measure the waits for the location locks and report the hottest locations
+        self.lock_report = False
+        # how the devices are run, see coroutines.RUNTIMES
+        self.runtime = RUNTIME_THREADS
+        # the number of processes of the sharded runtime, None for one for every CPU
+        self.shards = None
+        # how the devices store their sensor data, see device.STORAGES
+        self.storage = STORAGE_DICT
+        # file in which the shared sensor data is kept, so that other processes can read it;
+        # None for anonymous memory
+        self.data_file = None
+        # replay log file in which the interleaving of every iteration is recorded, the
+        # iteration number being added to its name when there are several; None for no log
+        self.record_file = None
+        # replay log of a recorded iteration, which is run again in the same interleaving
+        self.replay_file = None
 
     @staticmethod
     def create_simple_test_case():
@@ -192,16 +242,26 @@ class TestCase(object):
         else:
             self.devices = [DeviceTestData(i, [], []) for i in range(params.num_devices)]
 
-            # assign visited locations to devices
+            # assign visited locations to devices, keeping the inverse index too:
+            # the locations of each device, in increasing order
+            locations_for_devices = [[] for _ in xrange(params.num_devices)]
 
-            for i in range(self.num_locations):
-                num_devices = rand_gen.randint(1, params.overlap)
+            # randint(a, b) is written out in the loops below as a + int(random() * (b - a + 1)),
+            # to skip the call overhead: it is what randint draws in CPython 2, whose randrange
+            # returns start + int(random() * width) for any width below 2 ** 53, so a seed keeps
+            # giving the test cases of the older generator; with another randrange, use randint
+            rand = rand_gen.random
+
+            for i in xrange(self.num_locations):
+                num_devices = 1 + int(rand() * params.overlap)
                 devices_for_locations[i] = rand_gen.sample(xrange(params.num_devices), num_devices)
+                for device_id in devices_for_locations[i]:
+                    locations_for_devices[device_id].append(i)
 
+            # the sensor data is drawn device by device, in the order of the locations
             for device in self.devices:
-                for i in range(len(devices_for_locations)):
-                    if device.id in devices_for_locations[i]:
-                        device.locations.append(Location(i, rand_gen.randint(30, 100)))
+                device.locations.extend([Location(i, 30 + int(rand() * 71))
+                                         for i in locations_for_devices[device.id]])
 
         """ Create Scripts """
 
@@ -254,31 +314,268 @@ class TestCase(object):
                 if dev not in set_of_unique_devices:
                     encounters[rand_gen.randint(0, len(encounters)-1)].devices.append(dev)
 
-            for d in self.devices:
-                if d.id == device:
-                    d.encounters.extend(encounters)
-                    break
-
-        # print "Locations: ",
-        # for loc in range(len(devices_for_locations)):
-        #     print "%d:%s " % (loc, str(devices_for_locations[loc])),
-        # print
-        #
-        # for script in self.scripts:
-        #     print script
-        #
-        # for encounter in sorted([e for dev in self.devices for e in dev.encounters], key=lambda e : e.time_point):
-        #     print encounter, [d.id for d in self.devices if encounter in d.encounters]
-        #
-        # for dev in self.devices:
-        #     print "DeviceTestData(id=", dev.id
-        #     print "\tlocations="
-        #     for loc in dev.locations:
-        #         print "\t\t", loc
-        #     print "\tencounters="
-        #     for enc in dev.encounters:
-        #         print "\t\t", enc
+            # device i is the i-th element of the list
+            self.devices[device].encounters.extend(encounters)
+
+    def write(self, out_file):
+        """
+        Writes the elements of the test case in a readable form, one line per script and per
+        device, as they are iterated, so that large test cases are not built in memory again
+        as text.
+        @type out_file: File
+        @param out_file: the file where the test case is written
+        """
+        out_file.write("name=%s duration=%d extra_duration=%d num_locations=%d\n"
+                       % (self.name, self.duration, self.extra_duration, self.num_locations))
+
+        for script in self.scripts:
+            out_file.write("%s\n" % (script,))
+
+        for dev in self.devices:
+            out_file.write("DeviceTestData(id=%d, locations=%s, encounters=%s)\n"
+                           % (dev.id,
+                              " ".join("%d:%d" % (loc.id, loc.sensor_data) for loc in dev.locations),
+                              " ".join("%d:%s" % (enc.time_point, enc.devices)
+                                       for enc in dev.encounters)))
 
+    def save(self, filename):
+        """
+        Saves the test case in the binary format: the devices, their locations and encounters
+        and the scripts become flat arrays, the elements of device i being at positions
+        offsets[i] to offsets[i + 1] - 1 of their arrays.
+        @type filename: String
+        @param filename: the file in which the test case is saved
+        """
+        columns = {
+            "device_ids": array("i"),
+            "location_offsets": array("i", [0]),
+            "location_ids": array("i"),
+            "sensor_data": array("d"),
+            "encounter_offsets": array("i", [0]),
+            "encounter_time_points": array("i"),
+            "encounter_device_offsets": array("i", [0]),
+            "encounter_devices": array("i"),
+            "script_time_points": array("i", [script.time_point for script in self.scripts]),
+            "script_devices": array("i", [script.device for script in self.scripts]),
+            "script_locations": array("i", [script.location for script in self.scripts]),
+        }
+        integral = True
+
+        for dev in self.devices:
+            columns["device_ids"].append(dev.id)
+            for loc in dev.locations:
+                columns["location_ids"].append(loc.id)
+                columns["sensor_data"].append(loc.sensor_data)
+                integral = integral and isinstance(loc.sensor_data, (int, long))
+            columns["location_offsets"].append(len(columns["location_ids"]))
+            for enc in dev.encounters:
+                columns["encounter_time_points"].append(enc.time_point)
+                columns["encounter_devices"].extend(enc.devices)
+                columns["encounter_device_offsets"].append(len(columns["encounter_devices"]))
+            columns["encounter_offsets"].append(len(columns["encounter_time_points"]))
+
+        header = {attr : getattr(self, attr, None) for attr in BINARY_ATTRIBUTES}
+        header.update({"version": BINARY_VERSION,
+                       "byteorder": sys.byteorder,
+                       "integral_sensor_data": integral,
+                       "columns": {}})
+
+        # the offsets depend on the header length, which depends on the offsets: the
+        # columns are placed after a header long enough for any offset of the file
+        size = sum(len(column) * column.itemsize + COLUMN_ALIGNMENT
+                   for column in columns.values())
+        offset = len(BINARY_MAGIC) + HEADER_LENGTH.size
+        offset += len(json.dumps(dict(header, columns={name : ["d", size, size]
+                                                       for name in columns})))
+        for (name, column) in sorted(columns.items()):
+            offset += -offset % COLUMN_ALIGNMENT
+            header["columns"][name] = [column.typecode, offset, len(column)]
+            offset += len(column) * column.itemsize
+
+        with open(filename, "wb") as out_file:
+            out_file.write(BINARY_MAGIC)
+            out_file.write(HEADER_LENGTH.pack(len(json.dumps(header))))
+            out_file.write(json.dumps(header))
+            for (name, column) in sorted(columns.items()):
+                out_file.write("\0" * (header["columns"][name][1] - out_file.tell()))
+                column.tofile(out_file)
+
+    @staticmethod
+    def load(filename):
+        """
+        Loads a test case saved with save. The file is memory-mapped and every column is
+        read as a whole, the elements being built directly from the arrays.
+        @type filename: String
+        @param filename: the binary test case file
+        @rtype: TestCase
+        @return: a TestCase object
+        """
+        with open(filename, "rb") as in_file:
+            data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+                raise StandardError("%s is not a binary test case file" % filename)
+            start = len(BINARY_MAGIC) + HEADER_LENGTH.size
+            (length,) = HEADER_LENGTH.unpack(data[len(BINARY_MAGIC):start])
+            header = json.loads(data[start:start + length])
+            if header["version"] != BINARY_VERSION:
+                raise StandardError("Unsupported binary test case version %d" % header["version"])
+
+            columns = {}
+            for (name, (typecode, offset, length)) in header["columns"].items():
+                column = array(str(typecode))
+                column.fromstring(data[offset:offset + length * column.itemsize])
+                if header["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                columns[name] = column.tolist()
+        finally:
+            data.close()
+
+        test_case = TestCase()
+        for attr in BINARY_ATTRIBUTES:
+            value = header[attr]
+            # JSON has no tuples
+            setattr(test_case, attr, tuple(value) if isinstance(value, list) else value)
+        test_case.name = str(test_case.name)
+
+        sensor_data = columns["sensor_data"]
+        if header["integral_sensor_data"]:
+            sensor_data = [int(value) for value in sensor_data]
+        locations = map(Location, columns["location_ids"], sensor_data)
+
+        encounter_devices = columns["encounter_devices"]
+        device_offsets = columns["encounter_device_offsets"]
+        encounters = map(Encounter, columns["encounter_time_points"],
+                         [encounter_devices[device_offsets[i]:device_offsets[i + 1]]
+                          for i in xrange(len(device_offsets) - 1)])
+
+        location_offsets = columns["location_offsets"]
+        encounter_offsets = columns["encounter_offsets"]
+        test_case.devices = [DeviceTestData(dev_id,
+                                            locations[location_offsets[i]:location_offsets[i + 1]],
+                                            encounters[encounter_offsets[i]:encounter_offsets[i + 1]])
+                             for (i, dev_id) in enumerate(columns["device_ids"])]
+        test_case.scripts = map(ScriptTestData, columns["script_time_points"],
+                                columns["script_devices"], columns["script_locations"])
+
+        return test_case
+
+
+class TestCaseCache(object):
+    """
+    Directory of test cases saved in the binary format, named by a key identifying how they
+    were generated. When the directory grows over its maximum size, the least recently used
+    test cases are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        Constructor.
+        @type directory: String
+        @param directory: the cache directory, created when the first test case is saved
+        @type max_size: Integer
+        @param max_size: the maximum size of the saved test cases, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def file_key(filename, seed):
+        """
+        Returns the key of the test case generated from a test file and a seed: a hash of the
+        file contents, of the generator and format versions and of the seed.
+        @type filename: String
+        @param filename: the test file
+        @type seed: Integer
+        @param seed: the seed of the random generator, if the file has no gen_seed
+        @rtype: String
+        @return: the key
+        """
+        with open(filename, "rb") as test_file:
+            contents = test_file.read()
+
+        return hashlib.sha1("%d %d %d\n%s" % (GENERATOR_VERSION, BINARY_VERSION, seed,
+                                               contents)).hexdigest()
+
+    def path(self, key):
+        """
+        @rtype: String
+        @return: the file of the test case with the given key
+        """
+        return os.path.join(self.directory, "%s.bin" % key)
+
+    def get(self, key):
+        """
+        Loads a saved test case, marking it as the most recently used.
+        @type key: String
+        @param key: the key of the test case
+        @rtype: TestCase
+        @return: the test case, None if it is not in the cache
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        try:
+            test_case = TestCase.load(path)
+        except (StandardError, EnvironmentError):
+            # a damaged file is generated again
+            os.remove(path)
+            self.misses += 1
+            return None
+
+        os.utime(path, None)
+        self.hits += 1
+
+        return test_case
+
+    def put(self, key, test_case):
+        """
+        Saves a test case, then removes the least recently used ones if the cache is too big.
+        @type key: String
+        @param key: the key of the test case
+        @type test_case: TestCase
+        @param test_case: the test case
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # other processes using the cache never see a partly written file
+        path = self.path(key)
+        test_case.save("%s.%d" % (path, os.getpid()))
+        os.rename("%s.%d" % (path, os.getpid()), path)
+
+        self.evict(path)
+
+    def evict(self, keep):
+        """
+        Removes the least recently used test cases until the cache fits in its maximum size.
+        @type keep: String
+        @param keep: a file which is not removed
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".bin") and path != keep:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = os.path.getsize(keep) + sum(size for (_, size, _) in entries)
+        for (_, entry_size, path) in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+            self.evictions += 1
+
+    def __str__(self):
+        return "Test case cache: %d hits, %d misses, %d evicted" % (self.hits, self.misses,
+                                                                    self.evictions)
 
 
 class TestParams(object):
@@ -304,6 +601,18 @@ class TestParams(object):
         self.extra_duration = extra_duration
         self.script_assignment = script_assignment
 
+    def cache_key(self, seed):
+        """
+        Returns a key identifying the test case generated from these parameters and a seed,
+        usable as a file name.
+        @type seed: Integer
+        @param seed: the seed of the random generator, if gen_seed is not given
+        @rtype: String
+        @return: the key
+        """
+        return hashlib.sha1(json.dumps([GENERATOR_VERSION, BINARY_VERSION, seed,
+                                        sorted(vars(self).items())])).hexdigest()
+
     @staticmethod
     def load_test(filename):
         """
@@ -430,7 +739,7 @@ class TestParams(object):
                                                                    self.script_assignment)
 
 if __name__ == "__main__":
-    params = TestParams.load_test("../tests/test1")
-    print params
-    import random
-    TestCase.create_test_case(params, random.Random())
+    # python test.py <test file> [<seed>]: generates the test and writes it to stdout
+    params = TestParams.load_test(sys.argv[1] if len(sys.argv) > 1 else "../tests/test1")
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    TestCase.create_test_case(params, random.Random(seed)).write(sys.stdout)
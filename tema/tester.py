@@ -13,10 +13,15 @@ import pickle
 import random
 import subprocess
 import sys
+from multiprocessing.pool import ThreadPool
 from threading import Timer
 
+from coroutines import RUNTIME_COROUTINES, RUNTIME_SHARDED, RUNTIME_THREADS, RUNTIMES
+from sharding import FORK_SUPPORTED
+from device import STORAGE_ARRAY, STORAGE_DICT, STORAGE_SHARED, STORAGES
+from reference import numpy, REFERENCE_ARRAY, REFERENCE_DICT, REFERENCES
 from supervisor import Supervisor
-from test import TestCase, TestParams
+from test import TestCase, TestCaseCache, TestParams
 
 # Tester messages
 START_TEST_MSG       = "**************** Start %10s *****************"      # pylint: disable=bad-whitespace
@@ -25,23 +30,102 @@ TEST_ERRORS_MSG      = "Errors in iteration %d of %d:"                      # py
 TEST_FINISHED_MSG    = "%-10s finished.................%d%% completed"      # pylint: disable=bad-whitespace
 TIMEOUT_MSG          = "%-10s timeout..................%d%% completed"      # pylint: disable=bad-whitespace
 
+# How the iterations of a test are run
+RUN_MODE_PROCESS = "process"        # a new python process for every iteration
+RUN_MODE_INPROCESS = "inprocess"    # in the tester process
+RUN_MODE_WORKER = "worker"          # in a child process reused while iterations pass
+RUN_MODES = [RUN_MODE_PROCESS, RUN_MODE_INPROCESS, RUN_MODE_WORKER]
+
+# Default maximum size of the test case cache, in MB
+CACHE_SIZE = 256
+
+# Tests which are not described by a test file
+SPECIAL_TESTS = {
+    "test0": TestCase.create_simple_test_case,
+    "test9": TestCase.create_sharing1_test_case,
+    "test10": TestCase.create_sharing2_test_case,
+}
+
 class Tester(object):
     """
     Runs the test.
     """
-    def __init__(self, output_filename):
+    def __init__(self, output_filename, check_timepoints=False, mode=RUN_MODE_PROCESS,
+                 zero_delay=False, reference=REFERENCE_DICT, trace_file=None, lock_report=False,
+                 runtime=RUNTIME_THREADS, shards=None, storage=STORAGE_DICT, data_file=None,
+                 record_file=None, replay_file=None):
         """
         Constructor.
         @type output_filename: String
         @param output_filename: the file in which the tester logs results
+        @type check_timepoints: Boolean
+        @param check_timepoints: true to validate the data after every timepoint
+        @type mode: String
+        @param mode: how the iterations are run, one of RUN_MODES
+        @type zero_delay: Boolean
+        @param zero_delay: true to replace the script sleeps and delays with sleep(0)
+        @type reference: String
+        @param reference: the reference model used for validation, one of reference.REFERENCES
+        @type trace_file: String
+        @param trace_file: Chrome trace JSON file for the events of every iteration, None for
+            no tracing
+        @type lock_report: Boolean
+        @param lock_report: true to report the locations whose locks were waited for the most
+        @type runtime: String
+        @param runtime: how the devices are run, one of coroutines.RUNTIMES
+        @type shards: Integer
+        @param shards: the number of processes of the sharded runtime, None for one for every CPU
+        @type storage: String
+        @param storage: how the devices store their sensor data, one of device.STORAGES
+        @type data_file: String
+        @param data_file: file in which the shared sensor data is kept, None for anonymous memory
+        @type record_file: String
+        @param record_file: replay log file for the interleaving of every iteration, None for
+            no log
+        @type replay_file: String
+        @param replay_file: replay log of an iteration to run again, None to run normally
         """
         self.output_filename = output_filename
+        self.check_timepoints = check_timepoints
+        self.zero_delay = zero_delay
+        self.reference = reference
+        self.trace_file = trace_file
+        self.lock_report = lock_report
+        self.runtime = runtime
+        self.shards = shards
+        self.storage = storage
+        self.data_file = data_file
+        self.record_file = record_file
+        self.replay_file = replay_file
+        self.mode = mode
+        self.worker = None
 
         self.passed_tests = 0
 
         self.rand_gen = random.Random()
         self.rand_gen.seed(0)
 
+    def configure(self, testcase, num_iterations):
+        """
+        Copies the settings of the tester to a testcase, before its iterations are run.
+        @type testcase: TestCase
+        @param testcase: the testcase to run
+        @type num_iterations: Integer
+        @param num_iterations: number of time to run the test
+        """
+        testcase.num_iterations = num_iterations
+        testcase.check_timepoints = self.check_timepoints
+        testcase.zero_delay = self.zero_delay
+        testcase.reference = self.reference
+        testcase.trace_file = self.trace_file
+        testcase.lock_report = self.lock_report
+        testcase.runtime = self.runtime
+        testcase.shards = self.shards
+        testcase.storage = self.storage
+        testcase.data_file = self.data_file
+        testcase.record_file = self.record_file
+        testcase.replay_file = self.replay_file
+
     def run_test(self, testcase, num_iterations=1):
         """
         Performs a testcase generated from a given file or randomly.
@@ -56,7 +140,7 @@ class Tester(object):
 
         self.passed_tests = 0
 
-        testcase.num_iterations = num_iterations
+        self.configure(testcase, num_iterations)
         for i in range(num_iterations):
             print TEST_ERRORS_MSG % (i + 1, num_iterations)
             testcase.crt_iteration = i + 1
@@ -64,11 +148,64 @@ class Tester(object):
                 self.passed_tests += 1
                 print "No errors"
 
+        self.stop_worker()
+
         print END_TEST_MSG % testcase.name
 
+        self.write_result(testcase)
+
+    def run_tests(self, testcases, num_iterations=1, jobs=1):
+        """
+        Performs several testcases, running up to 'jobs' iterations at the same
+        time, each one in its own child process (and under its own watchdog).
+        The output of every iteration is captured and printed, like the results
+        in the output file, in the order of the testcases and iterations.
+        @type testcases: List of TestCase
+        @param testcases: the testcases to run
+        @type num_iterations: Integer
+        @param num_iterations: number of time to run each test
+        @type jobs: Integer
+        @param jobs: number of iterations run in parallel
+        """
+        children = []
+        for testcase in testcases:
+            self.configure(testcase, num_iterations)
+            for i in range(num_iterations):
+                testcase.crt_iteration = i + 1
+                children.append(pickle.dumps(testcase))
+
+        pool = ThreadPool(jobs)
+        results = iter(pool.map(Tester.run_child, children))
+        pool.close()
+        pool.join()
+
+        for testcase in testcases:
+            print START_TEST_MSG % testcase.name
+
+            self.passed_tests = 0
+
+            for i in range(num_iterations):
+                print TEST_ERRORS_MSG % (i + 1, num_iterations)
+                return_code, output = next(results)
+                sys.stdout.write(output)
+                if return_code == 0:
+                    self.passed_tests += 1
+                    print "No errors"
+
+            print END_TEST_MSG % testcase.name
+
+            self.write_result(testcase)
+
+    def write_result(self, testcase):
+        """
+        Logs the percentage of passed iterations of a testcase in the output file.
+        @type testcase: TestCase
+        @param testcase: the testcase which was run
+        """
         out_file = open(self.output_filename, "a")
 
-        msg = TEST_FINISHED_MSG % (testcase.name, 100.0 * self.passed_tests / num_iterations)
+        msg = TEST_FINISHED_MSG % (testcase.name,
+                                   100.0 * self.passed_tests / testcase.num_iterations)
 
         out_file.write(msg + "\n")
         out_file.close()
@@ -86,7 +223,40 @@ class Tester(object):
 
         os.abort()
 
+    def in_process_timer_fn(self, test):
+        """
+        Timer function used when the iterations run in the tester process. The
+        devices can not be stopped, so the progress is logged before aborting.
+        @type test: TestCase
+        @param test: the test case which timed out
+        """
+        out_file = open(self.output_filename, "a")
+        out_file.write(TIMEOUT_MSG % (test.name, 100.0 * self.passed_tests / test.num_iterations)
+                       + "\n")
+        out_file.close()
+
+        Tester.timer_fn(test.crt_iteration, test.num_iterations)
+
     def start_test(self, test):
+        """
+        Runs an iteration of the test case, as given by the tester's mode.
+
+        @type test: TestCase
+        @param test: an object containing all the information necessary for
+        running the test case
+        @rtype: Integer
+        @return: 0 if the iteration passed
+        """
+        if self.mode == RUN_MODE_INPROCESS:
+            return run_iteration(test, die_on_error=False,
+                                 timer_fn=self.in_process_timer_fn, timer_args=(test,))
+
+        if self.mode == RUN_MODE_WORKER:
+            return self.start_test_in_worker(test)
+
+        return self.start_test_in_process(test)
+
+    def start_test_in_process(self, test):
         """
         Starts a child process that will run the test case.
 
@@ -94,49 +264,238 @@ class Tester(object):
         @param test: an object containing all the information necessary for
         running the test case
         """
-        path = os.path.dirname(sys.argv[0])
-        path = "." if path == "" else path
-        command = "python %s/tester.py" % path
+        command = "python %s/tester.py" % Tester.get_path()
         test = pickle.dumps(test)
         process = subprocess.Popen(command, stdin=subprocess.PIPE, shell=True)
         process.communicate(test)
 
         return process.returncode
 
+    @staticmethod
+    def run_child(test):
+        """
+        Runs an iteration in a child process, capturing its output.
+
+        @type test: String
+        @param test: the pickled test case
+        @rtype: (Integer, String)
+        @return: the return code and the output of the child
+        """
+        command = "python %s/tester.py" % Tester.get_path()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, shell=True)
+        output, _ = process.communicate(test)
+
+        return process.returncode, output
+
+    def start_test_in_worker(self, test):
+        """
+        Runs the test case in the worker process, starting one if needed. The
+        test case is sent only once to a worker, then just the iteration numbers.
+        A worker is not reused after a failed iteration, as it may be left with
+        running device threads (or it may have aborted).
+
+        @type test: TestCase
+        @param test: an object containing all the information necessary for
+        running the test case
+        """
+        if self.worker is None:
+            command = "python %s/tester.py --worker" % Tester.get_path()
+            self.worker = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE, shell=True)
+            data = pickle.dumps(test)
+            self.worker.stdin.write("%d\n%s" % (len(data), data))
+
+        self.worker.stdin.write("%d\n" % test.crt_iteration)
+        self.worker.stdin.flush()
+
+        line = self.worker.stdout.readline()
+        if line == "":
+            return_code = self.worker.wait()
+            self.worker = None
+            return return_code
+
+        return_code = int(line)
+        if return_code != 0:
+            self.stop_worker()
+
+        return return_code
+
+    def stop_worker(self):
+        """
+        Stops the worker process, if there is one.
+        """
+        if self.worker is not None:
+            self.worker.stdin.close()
+            self.worker.wait()
+            self.worker = None
+
+    @staticmethod
+    def get_path():
+        """
+        Returns the directory of the tester script, used to start child processes.
+        """
+        path = os.path.dirname(sys.argv[0])
+        return "." if path == "" else path
+
+
+def run_iteration(test, die_on_error=True, timer_fn=None, timer_args=None):
+    """
+    Runs an iteration of the test case in the current process, under a watchdog.
+
+    @type test: TestCase
+    @param test: the test case to run
+    @type die_on_error: Boolean
+    @param die_on_error: true for the process to be killed on first error
+    @type timer_fn: Function
+    @param timer_fn: called on timeout, defaults to Tester.timer_fn
+    @type timer_args: Tuple
+    @param timer_args: the arguments of timer_fn
+    @rtype: Integer
+    @return: the number of errors
+    """
+    if timer_fn is None:
+        timer_fn = Tester.timer_fn
+        timer_args = (test.crt_iteration, test.num_iterations)
+
+    supervisor = Supervisor(test, die_on_error)
+
+    def timeout(*args):
+        # the recording of the iteration is saved before the timer function aborts
+        supervisor.save_recording()
+        timer_fn(*args)
+
+    watchdog = Timer(interval=test.timeout, function=timeout, args=timer_args)
+
+    watchdog.start()
+
+    supervisor.register_banned_thread(watchdog)
+    supervisor.register_banned_thread()
+    return_code = supervisor.run_testcase()
+
+    watchdog.cancel()
+    # a watchdog still alive would be seen as a device thread by the next iteration
+    watchdog.join()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    return return_code
+
+
+def run_worker():
+    """
+    Main loop of a worker process: reads a pickled test case from stdin, then
+    runs an iteration for every iteration number received, writing back the
+    return codes. Anything printed during the test goes to stderr.
+    """
+    results = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    size = int(sys.stdin.readline())
+    test = pickle.loads(sys.stdin.read(size))
+
+    for line in iter(sys.stdin.readline, ""):
+        test.crt_iteration = int(line)
+        return_code = run_iteration(test)
+        results.write("%d\n" % return_code)
+        results.flush()
+
 
 def usage(argv):
     print "Usage: python %s [OPTIONS]"%argv[0]
     print "options:"
-    print "\t-t,   --test\tspecial test to run"
+    print "\t-t,   --test\tspecial test to run (%s)" % ", ".join(sorted(SPECIAL_TESTS))
     print "\t-f,   --testfile\ttest file, if not specified run a pickled test from stdin"
+    print "\t\t\t\t-t and -f can be given several times, the tests are run in order"
     print "\t-o,   --out\t\toutput file"
     print "\t-i,   --iterations\t\tthe number of times the test is run (iterations), defaults to 2"
+    print "\t-c,   --check-timepoints\tvalidate the data after every timepoint, not only at the end"
+    print "\t-m,   --mode\t\thow iterations are run: %s (one process each, default)," % RUN_MODE_PROCESS
+    print "\t\t\t\t%s (in the tester, a timeout aborts the tester) or" % RUN_MODE_INPROCESS
+    print "\t\t\t\t%s (in a child process reused between passing iterations)" % RUN_MODE_WORKER
+    print "\t-z,   --zero-delay\treplace the script sleeps and delays with sleep(0)"
+    print "\t-r,   --reference\treference model used for validation: %s (default) or" % REFERENCE_DICT
+    print "\t\t\t\t%s (numpy arrays)" % REFERENCE_ARRAY
+    print "\t-g,   --cache-dir\tdirectory where the test cases generated from test files are"
+    print "\t\t\t\tsaved, and loaded from while the file does not change"
+    print "\t-s,   --cache-size\tthe maximum size of the cache directory in MB, defaults to %d" % CACHE_SIZE
+    print "\t-T,   --trace\t\tChrome trace JSON file for the events of the run, the iteration"
+    print "\t\t\t\tnumber being added to its name when there are several"
+    print "\t-l,   --lock-report\treport the waits for the location locks, for the hottest locations"
+    print "\t-R,   --runtime\t\thow the devices are run: %s (default), %s (on a single" % \
+        (RUNTIME_THREADS, RUNTIME_COROUTINES)
+    print "\t\t\t\tevent loop) or %s (event loops in several processes); the device" % \
+        RUNTIME_SHARDED
+    print "\t\t\t\timplementation is tested only by %s, which -T and -l need;" % RUNTIME_THREADS
+    print "\t\t\t\t%s needs fork, so it is not available on Windows" % RUNTIME_SHARDED
+    print "\t-n,   --shards\t\tthe number of processes of the %s runtime, defaults to the" % \
+        RUNTIME_SHARDED
+    print "\t\t\t\tnumber of CPUs"
+    print "\t-S,   --storage\t\thow the devices store their sensor data: %s (default), %s" % \
+        (STORAGE_DICT, STORAGE_ARRAY)
+    print "\t\t\t\tor %s (a table in shared memory, which other processes can read)" % \
+        STORAGE_SHARED
+    print "\t-d,   --data-file\tkeep the %s sensor data in this file, which can be read with" % \
+        STORAGE_SHARED
+    print "\t\t\t\tpython tema/shared_data.py FILE, the iteration number being added to"
+    print "\t\t\t\tits name when there are several; implies -S %s" % STORAGE_SHARED
+    print "\t-w,   --record\t\treplay log file in which the order of the script assignments,"
+    print "\t\t\t\tlocks and barrier waits is recorded, the iteration number being added"
+    print "\t\t\t\tto its name when there are several; in every mode, an iteration which"
+    print "\t\t\t\taborts (on an error or a timeout) saves the log of what it ran first"
+    print "\t-p,   --replay\t\trun the test again in the order recorded in a replay log,"
+    print "\t\t\t\twithout the script sleeps"
+    print "\t-j,   --jobs\t\tthe number of iterations run in parallel, in %s mode, defaults to 1" % RUN_MODE_PROCESS
     print "\t-h,   --help\t\tprint this help screen"
 
 
 def main():
     try:
-        opts, _ = getopt.getopt(sys.argv[1:], "h:t:f:o:i:",
-                                ["help", "--test", "testfile=", "out=", "iterations="])
+        opts, _ = getopt.getopt(sys.argv[1:], "h:t:f:o:i:cm:zr:g:s:T:lR:n:S:d:w:p:j:",
+                                ["help", "--test", "testfile=", "out=", "iterations=",
+                                 "check-timepoints", "mode=", "zero-delay", "reference=",
+                                 "cache-dir=", "cache-size=", "trace=", "lock-report", "runtime=",
+                                 "shards=", "storage=", "data-file=",
+                                 "record=", "replay=", "jobs=", "worker"])
 
     except getopt.GetoptError, err:
         print str(err)
         usage(sys.argv)
         sys.exit(2)
 
-    test_name = None
-    test_file = ""
+    tests = []
     iterations = 2
     output_file = "tester.out"
+    check_timepoints = False
+    mode = RUN_MODE_PROCESS
+    zero_delay = False
+    reference = REFERENCE_DICT
+    jobs = 1
+    worker = False
+    cache_dir = None
+    cache_size = CACHE_SIZE
+    trace_file = None
+    lock_report = False
+    runtime = RUNTIME_THREADS
+    shards = None
+    storage = STORAGE_DICT
+    data_file = None
+    record_file = None
+    replay_file = None
 
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             usage(sys.argv)
             sys.exit(0)
         elif opt in ("-t", "--test"):
-            test_name = arg
+            if arg not in SPECIAL_TESTS:
+                print "Unknown test %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            tests.append((arg, None))
         elif opt in ("-f", "--testfile"):
-            test_file = arg
+            tests.append((None, arg))
         elif opt in ("-o", "--out"):
             output_file = arg
         elif opt in ("-i", "--iterations"):
@@ -145,46 +504,139 @@ def main():
             except TypeError, err:
                 print str(err)
                 sys.exit(2)
+        elif opt in ("-c", "--check-timepoints"):
+            check_timepoints = True
+        elif opt in ("-m", "--mode"):
+            if arg not in RUN_MODES:
+                print "Unknown mode %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            mode = arg
+        elif opt in ("-z", "--zero-delay"):
+            zero_delay = True
+        elif opt in ("-r", "--reference"):
+            if arg not in REFERENCES:
+                print "Unknown reference model %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            if arg == REFERENCE_ARRAY and numpy is None:
+                print "The %s reference model needs numpy" % REFERENCE_ARRAY
+                sys.exit(2)
+            reference = arg
+        elif opt in ("-g", "--cache-dir"):
+            cache_dir = arg
+        elif opt in ("-s", "--cache-size"):
+            try:
+                cache_size = int(arg)
+            except ValueError, err:
+                print str(err)
+                sys.exit(2)
+        elif opt in ("-T", "--trace"):
+            trace_file = arg
+        elif opt in ("-l", "--lock-report"):
+            lock_report = True
+        elif opt in ("-R", "--runtime"):
+            if arg not in RUNTIMES:
+                print "Unknown runtime %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            runtime = arg
+        elif opt in ("-n", "--shards"):
+            try:
+                shards = int(arg)
+            except ValueError, err:
+                print str(err)
+                sys.exit(2)
+        elif opt in ("-S", "--storage"):
+            if arg not in STORAGES:
+                print "Unknown storage %s" % arg
+                usage(sys.argv)
+                sys.exit(2)
+            storage = arg
+        elif opt in ("-d", "--data-file"):
+            data_file = arg
+            storage = STORAGE_SHARED
+        elif opt in ("-w", "--record"):
+            record_file = arg
+        elif opt in ("-p", "--replay"):
+            replay_file = arg
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(arg)
+            except ValueError, err:
+                print str(err)
+                sys.exit(2)
+        elif opt == "--worker":
+            worker = True
         else:
             assert False, "unhandled option"
 
-    if test_name == "test0":
-        tester = Tester(output_file)
-        test = TestCase.create_simple_test_case()
-        tester.run_test(test, iterations)
-    elif test_name == "test9":
-        tester = Tester(output_file)
-        test = TestCase.create_sharing1_test_case()
-        tester.run_test(test, iterations)
-    elif test_name == "test10":
-        tester = Tester(output_file)
-        test = TestCase.create_sharing2_test_case()
-        tester.run_test(test, iterations)
-    elif test_file:
-        tester = Tester(output_file)
-        test_params = TestParams.load_test(test_file)
-        test = TestCase.create_test_case(test_params, tester.rand_gen)
-        tester.run_test(test, iterations)
+    if jobs > 1 and mode != RUN_MODE_PROCESS:
+        print "Parallel iterations are supported only in %s mode" % RUN_MODE_PROCESS
+        sys.exit(2)
 
-    else:  # I'm the child process :D
-        test = pickle.loads("".join(sys.stdin.readlines()))
+    if runtime == RUNTIME_SHARDED and not FORK_SUPPORTED:
+        print "The %s runtime needs fork, which this platform does not have" % RUNTIME_SHARDED
+        sys.exit(2)
 
-        watchdog = Timer(interval=test.timeout,
-                         function=Tester.timer_fn,
-                         args=(test.crt_iteration, test.num_iterations))
+    if (trace_file is not None or lock_report) and runtime != RUNTIME_THREADS:
+        print "Tracing and the lock report are supported only by the %s runtime" % RUNTIME_THREADS
+        sys.exit(2)
 
-        watchdog.start()
+    if (record_file is not None or replay_file is not None) and runtime != RUNTIME_THREADS:
+        print "Recording and replaying are supported only by the %s runtime" % RUNTIME_THREADS
+        sys.exit(2)
 
-        supervisor = Supervisor(test)
-        supervisor.register_banned_thread(watchdog)
-        supervisor.register_banned_thread()
-        return_code = supervisor.run_testcase()
+    if record_file is not None and replay_file is not None:
+        print "A run is either recorded or replayed"
+        sys.exit(2)
 
-        watchdog.cancel()
+    if tests:
+        tester = Tester(output_file, check_timepoints=check_timepoints, mode=mode,
+                        zero_delay=zero_delay, reference=reference, trace_file=trace_file,
+                        lock_report=lock_report, runtime=runtime, shards=shards,
+                        storage=storage, data_file=data_file, record_file=record_file,
+                        replay_file=replay_file)
+        cache = None
+        if cache_dir is not None:
+            cache = TestCaseCache(cache_dir, cache_size * 1024 * 1024)
+
+        testcases = []
+        for (test_name, test_file) in tests:
+            if test_name is not None:
+                testcases.append(SPECIAL_TESTS[test_name]())
+                continue
+
+            testcase = None
+            if cache is not None:
+                key = TestCaseCache.file_key(test_file, 0)
+                testcase = cache.get(key)
+
+            if testcase is None:
+                # every test is generated as if it was the only one
+                tester.rand_gen.seed(0)
+                test_params = TestParams.load_test(test_file)
+                testcase = TestCase.create_test_case(test_params, tester.rand_gen)
+                if cache is not None:
+                    cache.put(key, testcase)
+
+            testcases.append(testcase)
+
+        if cache is not None:
+            print cache
+
+        if jobs > 1:
+            tester.run_tests(testcases, iterations, jobs)
+        else:
+            for test in testcases:
+                tester.run_test(test, iterations)
 
-        sys.stdout.flush()
-        sys.stderr.flush()
-        sys.exit(return_code)
+    elif worker:
+        run_worker()
+
+    else:  # I'm the child process :D
+        test = pickle.loads("".join(sys.stdin.readlines()))
+        sys.exit(run_iteration(test))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+"""
+Testing infrastructure - records timestamped events of a run and exports them
+as Chrome trace JSON (chrome://tracing, Perfetto)
+
+Computer Systems Architecture Course
+Assignment 1
+March 2019
+"""
+
+import json
+from collections import deque
+from threading import current_thread, local
+from time import time
+
+# Events kept by every thread, the oldest ones being dropped first
+DEFAULT_CAPACITY = 100000
+
+
+class Tracer(object):
+    """
+    Records events in a ring buffer for every thread. A thread only appends to its own buffer,
+    so recording takes no lock; the buffers are read once the threads are done.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        """
+        Constructor.
+        @type capacity: Integer
+        @param capacity: the number of events kept for every thread
+        """
+        self.capacity = capacity
+        self.start = time()
+        self.__local = local()
+        # (thread name, buffer) for every thread which recorded events
+        self.__buffers = []
+
+    def __buffer(self):
+        """
+        @rtype: deque
+        @return: the buffer of the calling thread
+        """
+        try:
+            return self.__local.buffer
+        except AttributeError:
+            buffer = deque(maxlen=self.capacity)
+            self.__local.buffer = buffer
+            self.__buffers.append((current_thread().name, buffer))
+            return buffer
+
+    def record(self, name, start, device_id, timepoint, **args):
+        """
+        Records an event which started at the given time and ends now.
+        @type name: String
+        @param name: what happened
+        @type start: Float
+        @param start: when it started, as returned by time.time
+        @type device_id: Integer
+        @param device_id: the device on whose behalf it happened
+        @type timepoint: Integer
+        @param timepoint: the timepoint of the device
+        @param args: other values shown with the event
+        """
+        self.__buffer().append((name, start, time(), device_id, timepoint, args))
+
+    def instant(self, name, device_id, timepoint, **args):
+        """
+        Records an event without duration, happening now. The parameters are the ones of
+        record.
+        """
+        now = time()
+        self.__buffer().append((name, now, now, device_id, timepoint, args))
+
+    def events(self):
+        """
+        @rtype: List of Dictionary
+        @return: the recorded events, in the Chrome trace event format, times in microseconds
+            from the creation of the tracer
+        """
+        events = []
+        for (tid, (thread_name, buffer)) in enumerate(self.__buffers):
+            events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid,
+                           "args": {"name": thread_name}})
+            for (name, start, end, device_id, timepoint, args) in list(buffer):
+                event = {"name": name,
+                         "cat": "device %d" % device_id,
+                         "ph": "X" if end > start else "i",
+                         "ts": (start - self.start) * 1e6,
+                         "pid": 0,
+                         "tid": tid,
+                         "args": dict(args, device=device_id, timepoint=timepoint)}
+                if event["ph"] == "X":
+                    event["dur"] = (end - start) * 1e6
+                else:
+                    event["s"] = "t"
+                events.append(event)
+
+        return events
+
+    def export(self, filename):
+        """
+        Writes the recorded events to a Chrome trace JSON file.
+        @type filename: String
+        @param filename: the output file
+        """
+        with open(filename, "w") as out_file:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, out_file)